@@ -0,0 +1 @@
+../jsonstream.py
\ No newline at end of file
@@ -4,12 +4,15 @@
 # all the labels to label0, label1, etc., and renames each variable to v0, v1,
 # etc. The names restart at each new function. This change should not change the
 # behavior of the program at all.
+#
+# The program is read and written a function at a time (see jsonstream.py), as
+# JSON or, with --bin, binary (see brilbin.py).
 
-import json
 import sys
+from jsonstream import map_functions
+import brilbin
 
-def rename_vars():
-    prog = json.load(sys.stdin)
+def rename_vars(prog):
 
     for func in prog['functions']:
 
@@ -58,9 +61,12 @@ def rename_vars():
                 inst['label'] = labels[inst['label']]
             
 
-    json.dump(prog, sys.stdout, indent=2, sort_keys=True)
+    return prog
 
+def main():
+    brilbin.flag(sys.argv)
+    map_functions(rename_vars)
 
 
 if __name__ == '__main__':
-    rename_vars()
+    main()
@@ -0,0 +1 @@
+../brilpy.py
\ No newline at end of file
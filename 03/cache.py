@@ -0,0 +1 @@
+../cache.py
\ No newline at end of file
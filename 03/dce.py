@@ -3,37 +3,14 @@
 # Mark Moeller
 # Approach following Adrian Sampson DCE lesson videos; implementation mine.
 
-import json
 import sys
+from brilpy import form_blocks
+from jsonstream import stream_pass
+import brilbin
+import stats
 
 
-TERM = 'jmp', 'br', 'ret'
-
-# From bril repository
-def form_blocks(body):
-    cur_block = []
-
-    for inst in body:
-        if 'op' in inst:
-            cur_block.append(inst)
-
-            # check for term
-            if inst['op'] in TERM:
-                yield cur_block
-                cur_block = []
-
-        else: # label
-            if cur_block:
-                yield cur_block
-
-            cur_block = [inst]
-
-    yield cur_block
-
-def dce():
-    prog = json.load(sys.stdin)
-
-
+def dce(prog):
 
     for func in prog['functions']:
 
@@ -85,8 +62,63 @@ def dce():
 
             used = set()
 
-    json.dump(prog, sys.stdout)
+    return prog
+
+# Instructions that must stay even if their result is unused
+EFFECTS = 'call', 'print', 'store', 'free'
+
+# Worklist DCE, meant for programs in SSA form (though correct for any
+# program): keep a use count for each variable and the instructions defining
+# it. When a count reaches zero, the definitions are deleted (unless they have
+# side effects) and their args' counts go down in turn, so each instruction is
+# looked at a constant number of times.
+def dce_ssa(prog):
+
+    for func in prog['functions']:
+        instrs = func['instrs']
+
+        uses = {}    # var -> number of uses
+        defs = {}    # var -> indeces of instructions defining it
+
+        for i,inst in enumerate(instrs):
+            if 'args' in inst:
+                args = inst['args'][:1] if inst['op'] == 'getmbr' else inst['args']
+                for arg in args:
+                    uses[arg] = uses.get(arg, 0) + 1
+            if 'dest' in inst:
+                if inst['dest'] in defs:
+                    defs[inst['dest']].append(i)
+                else:
+                    defs[inst['dest']] = [i]
+
+        dead = [False] * len(instrs)
+        worklist = [v for v in defs if v not in uses]
+
+        while worklist:
+            v = worklist.pop()
+            for i in defs[v]:
+                inst = instrs[i]
+                if dead[i] or inst['op'] in EFFECTS:
+                    continue
+                dead[i] = True
+                if 'args' in inst:
+                    args = inst['args'][:1] if inst['op'] == 'getmbr' else inst['args']
+                    for arg in args:
+                        uses[arg] -= 1
+                        if uses[arg] == 0 and arg in defs:
+                            worklist.append(arg)
+
+        func['instrs'] = [inst for i,inst in enumerate(instrs) if not dead[i]]
+
+    return prog
+
+def main():
+    argv = brilbin.flag(stats.flag(sys.argv))
+    if len(argv) > 1 and argv[1] == '-ssa':
+        stream_pass('dce_ssa', dce_ssa)
+    else:
+        stream_pass('dce', dce)
 
 
 if __name__ == '__main__':
-    dce()
+    main()
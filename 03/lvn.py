@@ -2,22 +2,28 @@
 
 # Mark Moeller
 
-import json
 import sys
+from brilpy import form_blocks
+from jsonstream import stream_pass
+import brilbin
+import stats
 
 
-TERM = 'jmp', 'br', 'ret'
-
 COMMUTE = 'add', 'mul', 'eq', 'and', 'or'
 ARITH = 'add', 'mul', 'div'
 
 
+# Hashable form of a bril type (pointer types are dicts)
+def type_key(t):
+    if isinstance(t, dict):
+        return ('ptr', type_key(t['ptr']))
+    return t
+
 class Value:
 
-    def __init__(self, vals, oper, t,  args):
+    __slots__ = ('oper', 't', 'args', 'key', 'canonical')
 
-        # list of all values
-        self.values = vals
+    def __init__(self, oper, t, args):
 
         # node type of this Value
         self.oper = oper
@@ -25,67 +31,49 @@ class Value:
         # type of this value
         self.t = t
 
-        # list of indeces into vals reperesenting the args to this value
+        # tuple of indeces into the value list reperesenting the args to this
+        # value
         if oper in COMMUTE:
-            self.args = sorted(args)
+            self.args = tuple(sorted(args))
+        else:
+            self.args = tuple(args)
+
+        # What we hash and compare on. Calls are never equal to one another,
+        # so they have no key (and never go in the table).
+        if oper == 'call':
+            self.key = None
         else:
-            self.args = args
+            self.key = (oper, type_key(t), self.args)
 
         # this will get set later on, depending on whether this value already
         # exists
         self.canonical = []
 
     def __eq__(self, other):
-        if self.oper != other.oper or self.oper == 'call' or self.t != other.t:
-            return False
-        
-        for i,a in enumerate(self.args):
-            if a != other.args[i]:
-                return False
-
-        return True
+        return self.key is not None and self.key == other.key
 
+    def __hash__(self):
+        return hash(self.key)
 
     def __str__(self):
-        return '{} {} ({})'.format(self.oper, self.args, self.canonical)
+        return '{} {} ({})'.format(self.oper, list(self.args), self.canonical)
 
 # Return the index of the given val in values (creating one if it doesn't
-# exist yet)
-def index_of(values, val, name=[]):
-
-    try:
-        return values.index(val)  # linear search, eeek
-    except ValueError:
-        values += [val]
-        if name:
-            val.canonical = name
-        return len(values) - 1
+# exist yet). table maps each value's key to its index.
+def index_of(values, table, val, name=[]):
+
+    if val.key is not None and val.key in table:
+        return table[val.key]
+
+    values.append(val)
+    if val.key is not None:
+        table[val.key] = len(values) - 1
+    if name:
+        val.canonical = name
+    return len(values) - 1
     
 
-# From bril repository
-def form_blocks(body):
-    cur_block = []
-
-    for inst in body:
-        if 'op' in inst:
-            cur_block.append(inst)
-
-            # check for term
-            if inst['op'] in TERM:
-                yield cur_block
-                cur_block = []
-
-        else: # label
-            if cur_block:
-                yield cur_block
-
-            cur_block = [inst]
-
-    yield cur_block
-
-def lvn():
-    prog = json.load(sys.stdin)
-
+def lvn(prog):
 
     for func in prog['functions']:
 
@@ -115,6 +103,9 @@ def lvn():
             # Holds the list of values
             values = []
 
+            # Map value keys to indeces of `values`
+            table = {}
+
             # Map variable names to indeces of `values`
             variables = {}
 
@@ -133,8 +124,8 @@ def lvn():
                     # const instruction is special because the args aren't
                     # variable names
                     if instr['op'] == 'const':
-                        v = Value(values, 'const', instr['type'], [instr['value']])
-                        constval = index_of(values, v, name=instr['dest'])
+                        v = Value('const', instr['type'], [instr['value']])
+                        constval = index_of(values, table, v, name=instr['dest'])
                         variables[instr['dest']] = constval
 
                     # id is special in that we can just reuse the value
@@ -152,8 +143,8 @@ def lvn():
                                 # arg = renamed[arg]
 
                             if arg not in variables:
-                                v = Value(values, 'nonloc', 'nonloc', [arg])
-                                variables[arg] = index_of(values, v, name=arg)
+                                v = Value('nonloc', 'nonloc', [arg])
+                                variables[arg] = index_of(values, table, v, name=arg)
                                 
                             idx = variables[arg]
                             args += [idx]
@@ -165,22 +156,26 @@ def lvn():
 
                     
                         if 'dest' in instr:
-                            v = Value(values, instr['op'], instr['type'], args)
+                            v = Value(instr['op'], instr['type'], args)
 
                             if 'rename' in instr:
                                 name = new_name(instr['dest'])
-                                variables[instr['dest']] = variables[name] = index_of(values, v, name=name)
+                                variables[instr['dest']] = variables[name] = index_of(values, table, v, name=name)
                                 instr['dest'] = name
                                 instr.pop('rename')
                             else:
-                                variables[instr['dest']] = index_of(values, v, name=instr['dest'])
+                                variables[instr['dest']] = index_of(values, table, v, name=instr['dest'])
 
                 newinstr += [instr]
 
         func['instrs'] = newinstr
 
-    json.dump(prog, sys.stdout)
+    return prog
+
+def main():
+    brilbin.flag(stats.flag(sys.argv))
+    stream_pass('lvn', lvn)
 
 
 if __name__ == '__main__':
-    lvn()
+    main()
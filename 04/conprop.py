@@ -7,124 +7,95 @@
 import json
 import sys
 from brilpy import *
+from dataflow import Analysis, solve
 
 # ------------------------------------------------------------------------------
-# Worklist functions for computing `defined variables'
-# ------------------------------------------------------------------------------
-
-def defvars_init(func, graph):
-    in_b = [set([a['name'] for a in func['args']])]
-    out_b = [set()]
-    for i in range(graph.n-1):
-        in_b.append(set())
-        out_b.append(set())
-    return (in_b, out_b)
-
-# Transfer function for defined variables
-def defvars_xfer(in_b, block):
-    out_b = set(in_b)
-    for inst in block:
-        if 'dest' in inst:
-            out_b.add(inst['dest'])
-    return out_b
-
-def defvars_merge(pred_list):
-    result = set()
-    for p in pred_list:
-        result |= p
-    return result
-
-# ------------------------------------------------------------------------------
-# Worklist functions for computing `constant propagation'
+# `Defined variables' is now dataflow.DefinedVars (a bit-vector analysis).
+#
+# Dataflow analysis for computing `constant propagation'
 #
 # For constant propagation, we'll use a map from variable names to constant
 # values, with a name holding 'None' in the map if we know it is NOT constant.
 # ------------------------------------------------------------------------------
 
-def cp_init(func, graph):
-    in_b = []
-    out_b = []
-
-    in_b.append({})
-    out_b.append({})
+class ConstProp(Analysis):
 
-    if 'args' in func:
-        for arg in func['args']:
-            in_b[0][arg['name']] = None # Args are NOT constant
+    def __init__(self, func, graph):
+        self.func = func
+        self.blocks = graph.blocks
 
-    for i in range(graph.n - 1):
-        in_b.append({})
-        out_b.append({})
-    return (in_b, out_b)
+    def boundary(self):
+        # Args are NOT constant
+        return {arg['name']: None for arg in self.func.get('args', [])}
 
-def cp_xfer(in_b, block):
+    def top(self):
+        return {}
 
-    out_b = {}
-    for k,v in in_b.items():
-        out_b[k] = v
+    def transfer(self, b, in_b):
 
-    for inst in block:
-        if 'op' in inst and 'dest' in inst and inst['type'] == 'int':
-            if inst['op'] == 'const':
-                out_b[inst['dest']] = inst['value']
+        out_b = dict(in_b)
 
-            elif inst['op'] == 'call':
-                out_b[inst['dest']] = None # This analysis is intra-procedural only
+        for inst in self.blocks[b]:
+            if 'op' in inst and 'dest' in inst and inst['type'] == 'int':
+                if inst['op'] == 'const':
+                    out_b[inst['dest']] = inst['value']
 
-            else:
-                if len(inst['args']) == 1:
-                    # If the one arg is already guaranteed constant, then propagate
-                    if inst['args'][0] in out_b and inst['args'][0] != None:
-                        out_b[inst['dest']] = out_b[inst['args'][0]]
-                    # Otherwise, mark this var. non-constant
-                    else:
-                        out_b[inst['dest']] = None
+                elif inst['op'] == 'call':
+                    out_b[inst['dest']] = None # This analysis is intra-procedural only
 
                 else:
-                    # For two args: if both constant, we can fold and propagate
-                    if inst['args'][0] in out_b and out_b[inst['args'][0]] != None and \
-                       inst['args'][1] in out_b and out_b[inst['args'][1]] != None:
-                        
-                        op = { 'add' : (lambda x, y: x + y),
-                               'mul' : (lambda x, y: x * y),
-                               'sub' : (lambda x, y: x - y),
-                               'div' : (lambda x, y: int(x / y)) }
-
-                        out_b[inst['dest']] = op[inst['op']](out_b[inst['args'][0]], 
-                                                             out_b[inst['args'][1]])
-
-                    # Similar to above, in any other case, mark non-constant
+                    if len(inst['args']) == 1:
+                        # If the one arg is already guaranteed constant, then propagate
+                        if inst['args'][0] in out_b and inst['args'][0] != None:
+                            out_b[inst['dest']] = out_b[inst['args'][0]]
+                        # Otherwise, mark this var. non-constant
+                        else:
+                            out_b[inst['dest']] = None
+
                     else:
-                        out_b[inst['dest']] = None
+                        # For two args: if both constant, we can fold and propagate
+                        if inst['args'][0] in out_b and out_b[inst['args'][0]] != None and \
+                           inst['args'][1] in out_b and out_b[inst['args'][1]] != None:
 
-    return out_b
+                            op = { 'add' : (lambda x, y: x + y),
+                                   'mul' : (lambda x, y: x * y),
+                                   'sub' : (lambda x, y: x - y),
+                                   'div' : (lambda x, y: int(x / y)) }
 
-# pred_list: list of maps(var -> value)
-def cp_merge(pred_list):
+                            out_b[inst['dest']] = op[inst['op']](out_b[inst['args'][0]],
+                                                                 out_b[inst['args'][1]])
 
-    result = {}
+                        # Similar to above, in any other case, mark non-constant
+                        else:
+                            out_b[inst['dest']] = None
 
-    all_defined_vars = set()
+        return out_b
 
-    for p in pred_list:
-        all_defined_vars |= p.keys()
+    # facts: list of maps(var -> value)
+    def meet(self, facts):
 
-    for var in all_defined_vars:
+        result = {}
 
-        # Check that the values assigned to this variable *in the predecessors
-        # in which it is assigned* are all the same, and not None. If so, it is
-        # guaranteed to be a constant.
-        vals = [p[var] for p in pred_list if var in p]
+        all_defined_vars = set()
 
-        if vals.count(vals[0]) == len(vals) and None not in vals:
-            result[var] = vals[0]
-        else:
-            result[var] = None
+        for p in facts:
+            all_defined_vars |= p.keys()
+
+        for var in all_defined_vars:
+
+            # Check that the values assigned to this variable *in the predecessors
+            # in which it is assigned* are all the same, and not None. If so, it is
+            # guaranteed to be a constant.
+            vals = [p[var] for p in facts if var in p]
+
+            if vals.count(vals[0]) == len(vals) and None not in vals:
+                result[var] = vals[0]
+            else:
+                result[var] = None
+
+        return result
 
-    return result
-    
 
-        
 
 # ------------------------------------------------------------------------------
 
@@ -142,8 +113,7 @@ def main():
         print("func: {}".format(func['name']))
         g = CFG(func)
         
-        # (in_b, out_b) = run_worklist(func, cp_init, cp_xfer, cp_merge)
-        (in_b, out_b) = run_worklist(func, rd_init, rd_xfer, rd_merge)
+        (in_b, out_b) = solve(g, ConstProp(func, g))
 
         for i,name in enumerate(g.names):
             print("  {}:\n    consts in: {}\n    consts out:{}\n\n".format(name,
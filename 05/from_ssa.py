@@ -1,15 +1,20 @@
 #!/usr/bin/python3
 
 import sys
-import json
 from brilpy import *
 from functools import reduce
-from ssa import from_ssa
-
+from ssa import from_ssa, from_ssa_naive
+from jsonstream import stream_pass
+import brilbin
+import stats
 
+# usage: from_ssa.py [-naive] [--stats] [--bin] < prog.json
 def main():
-    prog = json.load(sys.stdin)
-    json.dump(from_ssa(prog), sys.stdout)
+    argv = brilbin.flag(stats.flag(sys.argv))
+    if len(argv) > 1 and argv[1] == '-naive':
+        stream_pass('from_ssa_naive', from_ssa_naive, cached=False)
+    else:
+        stream_pass('from_ssa', from_ssa, cached=False)
 
 
 if __name__ == '__main__':
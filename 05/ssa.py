@@ -0,0 +1 @@
+../ssa.py
\ No newline at end of file
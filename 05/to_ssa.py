@@ -1,12 +1,22 @@
 #!/usr/bin/python3
 import sys
-import json
 
-from ssa import to_ssa
+from ssa import to_ssa, MINIMAL, SEMI_PRUNED, PRUNED
+from jsonstream import stream_pass
+import brilbin
+import stats
 
+# usage: to_ssa.py [-minimal | -semipruned] [--stats] [--bin] < prog.json
+# (pruned SSA by default)
 def main():
-    prog = json.load(sys.stdin)
-    json.dump(to_ssa(prog), sys.stdout)
+    argv = brilbin.flag(stats.flag(sys.argv))
+    mode = PRUNED
+    if len(argv) > 1 and argv[1] == '-minimal':
+        mode = MINIMAL
+    elif len(argv) > 1 and argv[1] == '-semipruned':
+        mode = SEMI_PRUNED
+
+    stream_pass('to_ssa', lambda p: to_ssa(p, mode=mode), tool='to_ssa ' + mode)
 
 
 if __name__ == '__main__':
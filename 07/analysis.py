@@ -0,0 +1 @@
+../analysis.py
\ No newline at end of file
@@ -0,0 +1 @@
+../brilbin.py
\ No newline at end of file
@@ -0,0 +1 @@
+../dataflow.py
\ No newline at end of file
@@ -1,135 +1,262 @@
 #!/usr/bin/python3
+
+# Mark Moeller:
+# Loop invariant code motion for programs in SSA form.
+#
+# Every loop first gets a dedicated preheader: a new block just before the
+# header, which all the edges into the loop from outside now go through. Loops
+# are then visited innermost first (the order of brilpy.LoopForest.loops), and
+# each instruction in a loop whose args are all defined outside of it (or by
+# instructions already hoisted) moves to the end of the loop's preheader. The
+# preheader of an inner loop is itself inside the enclosing loop, so code
+# hoisted out of an inner loop can keep moving outward.
+#
+# An instruction is moved if either
+#   - it can't trap or have side effects (SAFE), so running it on a path where
+#     the original program wouldn't have is harmless, or
+#   - it's PURE and its block dominates every exit of the loop, so it would
+#     have run anyway.
+# A `div` whose divisor is a non-zero constant can't trap, so it counts as
+# safe. Preheaders left with no hoisted code (including inner ones whose code
+# all moved further out) are taken back out, so none is ever left empty.
+
+import sys
 from brilpy import *
-from dom import Dominators
-from functools import reduce
+from analysis import FunctionAnalyses
+from jsonstream import stream_pass
+import brilbin
+import stats
 
+# Ops with no side effects whose result depends only on their args
+PURE = 'const', 'id', 'add', 'mul', 'sub', 'div', 'eq', 'lt', 'gt', 'le', \
+       'ge', 'not', 'and', 'or', 'ptradd', 'getmbr', 'isnull'
 
-def main():
+# Pure ops that also can't trap
+SAFE = 'const', 'id', 'add', 'mul', 'sub', 'eq', 'lt', 'gt', 'le', 'ge', \
+       'not', 'and', 'or', 'ptradd', 'isnull'
+
+# Return a name starting with `base` that isn't in `used`, and add it to `used`
+def fresh(base, used):
+    name = base
+    i = 0
+    while name in used:
+        i += 1
+        name = '{}.{}'.format(base, i)
+    used.add(name)
+    return name
+
+# Ends in a jmp, br or ret (rather than falling through to the next block)
+def ends_in_term(block):
+    return 'op' in block[-1] and block[-1]['op'] in TERM
+
+# Add a preheader for each loop of g. Returns the new list of blocks, in layout
+# order, and a map from each preheader's label to the changes made for it, as
+# (instruction, key, old value), so that it can be taken back out. (For a jump
+# retargeted to the preheader, key is 'target' and the old value is the
+# header's label: the jump may also have been retargeted to the preheaders of
+# other loops, which must stay.) Each preheader ends with a jmp to its header.
+def add_preheaders(g, forest, labels, names):
+    before = {} # block idx -> preheaders to put before it
+    undo = {}
+
+    for loop in forest.loops:
+        h = loop.header
+        outside = [p for p in g.preds[h] if p not in loop]
+
+        # (the entry block has no preds to redirect, and to_ssa never makes it
+        # a header anyway)
+        if h == 0 or not outside or 'label' not in g.blocks[h][0]:
+            continue
+
+        hlabel = g.names[h]
+        plabel = fresh('_pre_' + hlabel, labels)
+        changes = []
+        pre = [{'label': plabel}]
+
+        for p in outside:
+            last = g.blocks[p][-1]
+            if 'labels' in last:
+                changes.append((last, 'target', hlabel))
+                last['labels'] = [plabel if l == hlabel else l for l in last['labels']]
+
+        # The preheader goes just before the header, so it can fall through to
+        # it, unless that would put it after a latch that falls through to the
+        # header. Then it goes after some other block that doesn't fall through
+        # (or failing that, the latch gets a jmp).
+        at = h
+        if (h - 1) in loop and not ends_in_term(g.blocks[h - 1]):
+            slots = [b for b in range(1, g.n + 1) if ends_in_term(g.blocks[b - 1])]
+            if slots:
+                at = min(slots, key=(lambda b: abs(b - h)))
+            else:
+                jmp = {'op': 'jmp', 'labels': [hlabel]}
+                g.blocks[h - 1].append(jmp)
+                changes.append((jmp, None, None))
+
+        # Header phis take their values from outside the loop through the
+        # preheader (merging them there if there's more than one way in)
+        outside_labels = set([g.names[p] for p in outside])
+        for inst in g.blocks[h]:
+            if 'op' not in inst or inst['op'] != 'phi':
+                continue
+            changes.append((inst, 'args', inst['args']))
+            changes.append((inst, 'labels', inst['labels']))
+
+            out = [(a, l) for (a, l) in zip(inst['args'], inst['labels'])
+                   if l in outside_labels]
+            keep = [(a, l) for (a, l) in zip(inst['args'], inst['labels'])
+                    if l not in outside_labels]
+            if len(set([a for (a, l) in out])) > 1:
+                phi = {'op': 'phi', 'dest': fresh(inst['dest'] + '.pre', names),
+                       'args': [a for (a, l) in out], 'labels': [l for (a, l) in out]}
+                if 'type' in inst:
+                    phi['type'] = inst['type']
+                pre.append(phi)
+                out = [(phi['dest'], plabel)]
+            elif out:
+                out = [(out[0][0], plabel)]
+
+            inst['args'] = [a for (a, l) in keep + out]
+            inst['labels'] = [l for (a, l) in keep + out]
+
+        pre.append({'op': 'jmp', 'labels': [hlabel]})
+        before.setdefault(at, []).append(pre)
+        undo[plabel] = changes
+
+    blocks = []
+    for i in range(g.n + 1):
+        blocks += before.get(i, [])
+        if i < g.n:
+            blocks.append(g.blocks[i])
+
+    return (blocks, undo)
+
+# Revert the changes recorded by add_preheaders for the preheader labelled
+# plabel. Returns the ids of the jmps it added, which the caller must delete.
+def remove_preheader(plabel, changes):
+    jmps = set()
+    for (inst, key, old) in reversed(changes):
+        if key is None:
+            jmps.add(id(inst))
+        elif key == 'target':
+            inst['labels'] = [old if l == plabel else l for l in inst['labels']]
+        else:
+            inst[key] = old
+    return jmps
+
+def licm_func(func, fa):
+
+    # var -> defining instruction
+    defs = {}
+    for inst in func['instrs']:
+        if 'dest' in inst:
+            if inst['dest'] in defs:
+                print("warning: `{}` is assigned more than once in function `{}`; "
+                      "skipping LICM (this pass assumes SSA).".format(inst['dest'],
+                      func['name']), file=sys.stderr)
+                return
+            defs[inst['dest']] = inst
 
-    prog = json.load(sys.stdin)
+    g = fa.cfg()
+    if not fa.loops().loops:
+        return
 
+    labels = set([inst['label'] for inst in func['instrs'] if 'label' in inst])
+    names = set(defs) | set([a['name'] for a in func.get('args', [])])
+
+    (blocks, undo) = add_preheaders(g, fa.loops(), labels, names)
+    func['instrs'] = [inst for block in blocks for inst in block]
+    fa.invalidate('cfg')
+
+    g = fa.cfg()
+    doms = fa.dominators()
+    forest = fa.loops()
+
+    # var -> idx of the block defining it (args are in no block)
+    def_block = {}
+    for b,block in enumerate(g.blocks):
+        for inst in block:
+            if 'dest' in inst:
+                def_block[inst['dest']] = b
+
+    def nonzero_const(var):
+        inst = defs.get(var)
+        return inst is not None and inst['op'] == 'const' and inst['value'] != 0
+
+    rpo = g.rpo()
+
+    for loop in forest.loops:
+        h = loop.header
+        outside = [p for p in g.preds[h] if p not in loop]
+        if len(outside) != 1 or g.names[outside[0]] not in undo:
+            continue # no preheader
+        pre = outside[0]
+
+        exits = loop.exits()
+
+        # Blocks of the loop in reverse postorder, so each (non-phi) def is
+        # seen before its uses
+        for b in [b for b in rpo if b in loop]:
+            always = exits and all(doms.dominates(b, x) for x in exits)
+
+            moved = []
+            for inst in g.blocks[b]:
+                if 'dest' not in inst or inst['op'] not in PURE:
+                    continue
+
+                op = inst['op']
+                if not (op in SAFE or always or
+                        (op == 'div' and nonzero_const(inst['args'][1]))):
+                    continue
+
+                if any(def_block.get(a) is not None and def_block[a] in loop
+                       for a in inst.get('args', [])):
+                    continue
+
+                moved.append(inst)
+                def_block[inst['dest']] = pre
+
+            if moved:
+                ids = set([id(inst) for inst in moved])
+                g.blocks[b][:] = [inst for inst in g.blocks[b] if id(inst) not in ids]
+                # before the preheader's jmp
+                g.blocks[pre][-1:-1] = moved
+
+    # Labels of the preheaders still holding hoisted code. (An inner loop's may
+    # have lost all of it again, to the preheader of an enclosing loop.)
+    hoisted = set([g.names[b] for b in range(g.n) if g.names[b] in undo and
+                   any('op' in inst and inst['op'] not in ('phi', 'jmp')
+                       for inst in g.blocks[b])])
+
+    dropped = set()
+    for label,changes in undo.items():
+        if label not in hoisted:
+            dropped |= remove_preheader(label, changes)
+
+    # Lay the blocks out again, leaving out the preheaders that got nothing, and
+    # the jmps of the others that can fall through to their headers instead
+    newinstrs = []
+    for b,block in enumerate(g.blocks):
+        if g.names[b] in undo:
+            if g.names[b] not in hoisted:
+                continue
+            if b + 1 < g.n and g.names[b + 1] == block[-1]['labels'][0]:
+                block = block[:-1]
+        newinstrs += [inst for inst in block if id(inst) not in dropped]
+
+    func['instrs'] = newinstrs
+    fa.invalidate('cfg')
+
+# am: an analysis.AnalysisManager to share analyses with other passes, if any
+def licm(prog, am=None):
     for func in prog['functions']:
+        if func['instrs']:
+            licm_func(func, am.function(func) if am else FunctionAnalyses(func))
+    return prog
 
-        g = CFG(func)
-        doms = Dominators(func)
-
-        natloops = []
-
-        for u,nbrs in enumerate(g.edges):
-            for v in nbrs:
-                if v in doms.doms[u]:
-                    # v dominates u
-                    # u -> v is the backedge
-                    natloop = list(doms.doms[u].intersection(doms.dom_by[v]))
-                    natloop.remove(v)
-                    natloop = [v] + natloop
-                    natloops.append(natloop)
-
-        # Combine loops that have the same header:
-        natloops.sort(key=(lambda x: x[0]))
-        i = 0
-        while i < len(natloops):
-            head = natloops[i][0]
-            j = i+1
-            while j < len(natloops) and head == natloops[j][0]:
-                for k in natloops[j]:
-                    if k not in natloops[i]:
-                        natloops[i].append(k)
-                natloops.pop(j)
-            i = j
-
-        (in_b, out_b) = run_worklist(func, rd_init, rd_xfer, rd_merge)
-
-        for loop in natloops:
-
-            exits = []
-            for i in loop:
-                if set(g.edges[i]).difference(loop):
-                    exits.append(i)
-
-            dom_all_exits = reduce(set.intersection, [doms.doms[x] for x in exits], set(range(g.n)))
-            eligible_for_motion = dom_all_exits.intersection(loop)
-
-            header = loop[0] # block idx of the header
-            preheader = [] # list of instructions that will go in the preheader
-
-            loopinvariant = set() # set of vars to check against
-            move_list = [] # list of tuples: (block_idx, instr_idx, instr)
-
-            # Iterate to convergeance:
-            changed = True
-            while changed:
-                changed = False
-
-                # Go through all the instructions in the loop looking for loop
-                # invariant ones
-                for idx in loop:
-                    for i,inst in enumerate(g.blocks[idx]):
-                        if 'dest' in inst and 'args' in inst and inst['op'] != 'phi'  \
-                        and inst['op'] != 'div' and (idx, i, inst) not in move_list:
-                            args_invar = True
-
-                            for x in inst['args']:
-                                args_invar = args_invar and (x in loopinvariant
-                                        or out_b[idx][x] not in loop)
-                            if args_invar:
-                                loopinvariant.add(inst['dest'])
-                                if idx in eligible_for_motion:
-                                    changed = True
-                                    move_list.append((idx, i, inst))
-
-
-            # Form/insert preheader
-            if move_list:
-                # Sort back to front by inst index, so we can delete easily
-                move_list.sort(key=(lambda x: x[1]), reverse=True)
-                hdr_label = g.blocks[header][0]['label']
-                prehdr_label = '_pre_' + hdr_label
-                preheader = [{'label':prehdr_label}]
-                for tup in move_list:
-                    (idx, i, inst) = tup
-                    preheader.append(inst)
-                    g.blocks[idx].pop(i)
-
-                # Update the labels of the non-loop predecessors of header to
-                # goto preheader
-                for p in g.preds[header]:
-                    if p not in loop and 'labels' in g.blocks[p][-1]:
-                        new_labels = []
-                        for lbl in g.blocks[p][-1]['labels']:
-                            if lbl == g.blocks[header][0]['label']:
-                                new_labels.append(prehdr_label)
-                            else:
-                                new_labels.append(lbl)
-                        g.blocks[p][-1]['labels'] = new_labels
-
-                loop_labels = set([g.blocks[i][0]['label'] for i in loop])
-
-                # Also need to update phis (if any) in header to come from
-                # preheader instead of anywhere outside the loop
-                i = 0
-                while 'label' in g.blocks[header][i]:
-                    i += 1
-
-                while i < len(g.blocks[header]) and 'op' in g.blocks[header][i] and \
-                      g.blocks[header][i]['op'] == 'phi':
-
-                    new_labels = []
-                    for lbl in g.blocks[header][i]['labels']:
-                        if lbl in loop_labels:
-                            new_labels.append(lbl)
-                        else:
-                            new_labels.append(prehdr_label)
-                    g.blocks[header][i]['labels'] = new_labels
-                    i += 1
-
-                # Prepend the header to the old block
-                g.blocks[header] = preheader + g.blocks[header]
-
-
-            func['instrs'] = reduce(lambda x,y: x+y, [g.blocks[i] for i in range(g.n)], [])
-
-    json.dump(prog, sys.stdout)
+def main():
+    brilbin.flag(stats.flag(sys.argv))
+    stream_pass('licm', licm)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1 @@
+../stats.py
\ No newline at end of file
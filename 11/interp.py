@@ -0,0 +1 @@
+../interp.py
\ No newline at end of file
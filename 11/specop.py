@@ -1,25 +1,219 @@
 #!/usr/bin/python3
+
+# Mark Moeller:
+# Profile-guided trace formation ("superblocks").
+#
+# Using the block and edge counts from a profiling run (interp.py), each
+# function's hot loops are found by growing a trace from the hottest block not
+# yet in one, following the most likely edge out of each block, until it comes
+# back around to where it started. A trace B1 -> B2 -> ... -> Bk (-> B1) is
+# then laid out as straight-line code right after B1:
+#
+#   B1; B2'; ...; Bk'; B1'     (B1' goes on to B2')
+#
+# where the primed blocks are copies reached only along the trace. A jmp to the
+# next block of the trace becomes a fallthrough, and each br becomes a guard:
+# its on-trace label goes to the next copy, and the other is a side exit to the
+# original block it targeted, so the rest of the function is left as it was.
+# Copying B1 to the end as well (B1') means the loop's back edge needs no jmp.
+#
+# The copies compute exactly what the original blocks would have, so at a side
+# exit the state is just what the original code expects there: nothing needs
+# to be undone, and a trace can go through calls, prints and stores. Blocks
+# taking part in phis can't simply be copied, so functions with phis (i.e.,
+# in SSA form) are skipped.
+#
+# usage: specop.py [--profile FILE] [--bin] [ARGS ...]  < prog.json
+#
+# Without --profile, the program is first run with ARGS (by interp.py, in this
+# process) to get the profile. As a pipeline.py pass, the profile is read from
+# PROFILE.
+
 import sys
+import io
+import json
 from brilpy import *
+import interp
+import brilbin
 
-PROFILE = 'profile.txt'
+PROFILE = 'profile.json'
 
-def main():
+# A block must have run at least this many times to start a trace
+HOT = 8
+
+# An edge is followed if it was taken at least this fraction of the times its
+# block ran
+LIKELY = 0.5
+
+# Longest trace, in blocks
+MAX_LEN = 64
+
+# Return a name starting with `base` that isn't in `used`, and add it to `used`
+def fresh(base, used):
+    name = base
+    i = 0
+    while name in used:
+        i += 1
+        name = '{}.{}'.format(base, i)
+    used.add(name)
+    return name
+
+# Pick the traces of a function from its profile (as from interp.Func.profile)
+# and block names. Returns a list of traces, each a list of block indices.
+def select_traces(names, fprof):
+    index = {name: i for i,name in enumerate(names)}
+    counts = [fprof['blocks'].get(name, 0) for name in names]
+
+    # block idx -> (succ idx, count) of its most frequent edge
+    likely = {}
+    for (p, s, c) in fprof['edges']:
+        p = index[p]
+        if c > 0 and (p not in likely or c > likely[p][1]):
+            likely[p] = (index[s], c)
+
+    traces = []
+    taken = set()
+    for seed in sorted(range(len(names)), key=(lambda b: -counts[b])):
+        if counts[seed] < HOT:
+            break
+        if seed in taken:
+            continue
+
+        trace = [seed]
+        b = seed
+        while len(trace) < MAX_LEN and b in likely:
+            (s, c) = likely[b]
+            if c < LIKELY * counts[b] or s in taken:
+                break
+            if s == seed:
+                # back around: it's a loop
+                traces.append(trace)
+                taken.update(trace)
+                break
+            if s in trace:
+                break
+            trace.append(s)
+            b = s
+
+    return traces
+
+def copy_inst(inst):
+    return {k: (list(v) if isinstance(v, list) else v) for (k, v) in inst.items()}
+
+# Point the end of `block` (a list of instructions) at label `to` instead of
+# block `succ` (with label `succ_label`, or None). If `falls` is set, the block
+# for `to` comes right after this one.
+def retarget(block, succ_label, to, falls):
+    last = block[-1] if block else None
+    if last is not None and 'op' in last and last['op'] == 'jmp':
+        if falls:
+            block.pop()
+        else:
+            last['labels'] = [to]
+    elif last is not None and 'op' in last and last['op'] == 'br':
+        last['labels'] = [to if l == succ_label else l for l in last['labels']]
+    elif not falls:
+        # (fell through to succ)
+        block.append({'op': 'jmp', 'labels': [to]})
 
-    prog = json.load(sys.stdin)
+def specop_func(func, fprof):
+    if any('op' in inst and inst['op'] == 'phi' for inst in func['instrs']):
+        print("warning: function `{}` has phis; skipping trace formation.".format(
+              func['name']), file=sys.stderr)
+        return
 
-    # Hack to make brench work: we wait to open 'profile.txt' until *after*
+    blocks = list(form_blocks(func['instrs']))
+    names = []
+    for i,block in enumerate(blocks):
+        names.append(block[0]['label'] if 'label' in block[0] else 'b' + str(i))
+
+    if set(fprof['blocks']) != set(names):
+        print("warning: profile doesn't match function `{}`; skipping trace "
+              "formation.".format(func['name']), file=sys.stderr)
+        return
+
+    traces = select_traces(names, fprof)
+    if not traces:
+        return
+
+    labels = set([inst['label'] for inst in func['instrs'] if 'label' in inst])
+
+    def label_of(b):
+        return blocks[b][0]['label'] if 'label' in blocks[b][0] else None
+
+    after = {} # block idx -> trace copies laid out after it
+    for trace in traces:
+        # copy of each block of the trace after the first, then of the first
+        order = trace[1:] + trace[:1]
+        copies = []
+        for b in order:
+            block = [copy_inst(inst) for inst in blocks[b] if 'op' in inst]
+            block.insert(0, {'label': fresh(names[b] + '.t', labels)})
+            copies.append(block)
+
+        # Each block goes on to the copy after it; B1 (the original, just
+        # before the copies) to B2', and B1' (the last copy) back to B2'
+        k = len(trace)
+        head = blocks[trace[0]]
+        retarget(head, label_of(trace[1 % k]), copies[0][0]['label'], True)
+        for i in range(k):
+            succ = order[(i + 1) % k]
+            to = copies[(i + 1) % k][0]['label']
+            retarget(copies[i], label_of(succ), to, i + 1 < k)
+        after[trace[0]] = copies
+
+    newinstrs = []
+    for b,block in enumerate(blocks):
+        newinstrs += block
+        for c in after.get(b, []):
+            newinstrs += c
+    func['instrs'] = newinstrs
+
+# profile: as from interp.Program.profile; read from PROFILE if not given
+def specop(prog, profile=None):
+
+    # Hack to make brench work: we wait to open the profile until *after*
     # we've finished reading from stdin
-    trace = json.load(open(PROFILE))
+    if profile is None:
+        profile = json.load(open(PROFILE))
 
-    mainfunc = list(filter(lambda x: x['name'] == 'main', prog['functions']))[0]
-    
-    instrs = mainfunc["instrs"]
-    t_instrs = trace["instrs"]
+    for func in prog['functions']:
+        fprof = profile['functions'].get(func['name'])
+        if func['instrs'] and fprof and fprof['calls']:
+            specop_func(func, fprof)
 
-    mainfunc["instrs"] = t_instrs + [{"label":"recover"}] + instrs
+    return prog
+
+# Run prog on args with interp.py (output discarded) and return its profile, or
+# None if the program fails
+def run_profile(prog, args):
+    try:
+        p = interp.Program(prog, out=io.StringIO())
+        p.run(args)
+    except interp.BrilError as e:
+        print("warning: profiling run failed ({}); no traces formed.".format(e),
+              file=sys.stderr)
+        return None
+    return p.profile()
+
+def main():
+    argv = brilbin.flag(sys.argv[1:])
+    profile = None
+    args = []
+    while argv:
+        a = argv.pop(0)
+        if a == '--profile':
+            profile = json.load(open(argv.pop(0)))
+        else:
+            args.append(a)
 
-    json.dump(prog, sys.stdout)
+    prog = brilbin.read_program()
+    if profile is None:
+        sys.setrecursionlimit(100000)
+        profile = run_profile(prog, args)
+    if profile is not None:
+        prog = specop(prog, profile)
+    brilbin.write_program(prog)
 
 if __name__ == '__main__':
     main()
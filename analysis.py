@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# Caches per-function analyses (CFG, dominators, reaching definitions, natural
+# loops) so that passes running in the same process can share them instead of
+# each rebuilding their own.
+#
+# A pass that changes a function's IR is responsible for calling invalidate()
+# with the analyses it broke; anything that depends on an invalidated analysis
+# is dropped along with it. A cached CFG stays valid as long as the function's
+# instrs are exactly the concatenation of g.blocks (in order), with the same
+# labels and terminators, so passes that only edit instructions inside blocks
+# can keep it by editing g.blocks in place and rebuilding func['instrs'] from
+# them.
+
+from brilpy import CFG, LoopForest
+from dom import Dominators
+from dataflow import ReachingDefs
+import stats
+
+# analysis name -> analyses that must be invalidated along with it (listed
+# transitively, so invalidate() needn't recurse)
+DEPENDENTS = {
+    'cfg': ['dominators', 'reaching_defs', 'loops'],
+    'dominators': ['loops'],
+    'reaching_defs': [],
+    'loops': [],
+}
+
+class FunctionAnalyses:
+    """ Lazily computed analyses for a single function. Each is computed the
+    first time it is requested and then cached until invalidated.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.cache = {}
+
+    def get(self, name):
+        if name not in self.cache:
+            with stats.timer('analysis.' + name):
+                self.cache[name] = getattr(self, '_compute_' + name)()
+        return self.cache[name]
+
+    def cfg(self):
+        return self.get('cfg')
+
+    def dominators(self):
+        return self.get('dominators')
+
+    # (in_b, out_b) of the SSA reaching definitions analysis, as var -> block
+    # maps (see dataflow.RDView)
+    def reaching_defs(self):
+        return self.get('reaching_defs')
+
+    # The brilpy.LoopForest of the function
+    def loops(self):
+        return self.get('loops')
+
+    def _compute_cfg(self):
+        return CFG(self.func)
+
+    def _compute_dominators(self):
+        return Dominators(self.func, self.cfg())
+
+    def _compute_reaching_defs(self):
+        g = self.cfg()
+        return ReachingDefs(self.func, g).run(g)
+
+    def _compute_loops(self):
+        return LoopForest(self.cfg(), self.dominators())
+
+    # Drop the named analyses (all of them if none are named), and everything
+    # that depends on them
+    def invalidate(self, *names):
+        if not names:
+            names = DEPENDENTS.keys()
+
+        for name in names:
+            self.cache.pop(name, None)
+            for dep in DEPENDENTS[name]:
+                self.cache.pop(dep, None)
+
+
+class AnalysisManager:
+    """ Hands out the FunctionAnalyses for each function of a program. """
+    def __init__(self):
+        self.funcs = {}
+
+    def function(self, func):
+        fa = self.funcs.get(func['name'])
+        if fa is None or fa.func is not func:
+            fa = FunctionAnalyses(func)
+            self.funcs[func['name']] = fa
+        return fa
+
+    # Invalidate the named analyses for every function (e.g., after a pass
+    # that doesn't know about the analysis manager)
+    def invalidate(self, *names):
+        for fa in self.funcs.values():
+            fa.invalidate(*names)
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# Runs the benchmarks of a brench config (bril-bench.toml) in parallel, and
+# records more than brench does.
+#
+# usage: bench.py [-j JOBS] [-n REPEAT] [-o RESULTS.json] CONFIG.toml > results.csv
+#
+# Each run of a benchmark goes through the run's pipeline one command at a
+# time (the output of each is the input to the next), so every command gets its
+# own wall time and peak RSS. The figure of merit (`extract`, e.g. the
+# total_dyn_inst from `brili -p`) comes from the last command's stderr, and the
+# output is checked against that of the `baseline` run, as brench does.
+#
+# Runs happen JOBS at a time (default: one per cpu), each in a working
+# directory of its own: a scratch copy of the config's directory (and its
+# parent) made of symlinks, so relative paths like `../pipeline.py` still work,
+# but files a run writes (e.g., `profile.json`) aren't seen by any other.
+#
+# stdout gets the same CSV brench writes (benchmark,run,result). RESULTS.json,
+# if given, gets everything: for each benchmark and run, the result of each of
+# the REPEAT repetitions, and the mean and standard deviation of the wall time
+# of each command and of the whole pipeline, and their peak RSS.
+#
+# Peak RSS is sampled from /proc while a command runs, so a command that's
+# done before it's first sampled (e.g., a `cat` of a small file) has none:
+# it's null in RESULTS.json, not 0, and left out of the maxima. The samplers
+# are threads of this process, like the ones timing the commands, so with many
+# jobs a timing can end a little late, waiting for the GIL; for the closest
+# wall times, use fewer jobs than cpus.
+
+import glob
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tomllib
+except ImportError: # before Python 3.11
+    import tomli as tomllib
+
+BASELINE = 'baseline'
+
+# Make a directory for one run: a temp dir standing in for the parent of
+# `confdir`, with symlinks to everything in the real parent except confdir,
+# which is a real directory of symlinks to its contents. Returns (temp dir, the
+# working directory for the run).
+def make_workdir(confdir):
+    parent = os.path.dirname(confdir)
+    here = os.path.basename(confdir)
+    tmp = tempfile.mkdtemp(prefix='bench.')
+    for name in os.listdir(parent):
+        if name != here:
+            os.symlink(os.path.join(parent, name), os.path.join(tmp, name))
+    work = os.path.join(tmp, here)
+    os.mkdir(work)
+    for name in os.listdir(confdir):
+        os.symlink(os.path.join(confdir, name), os.path.join(work, name))
+    return (tmp, work)
+
+# How often to sample the memory use of running commands
+SAMPLE = 0.002 # s
+
+with open('/proc/self/cmdline', 'rb') as f:
+    OWN_CMDLINE = f.read()
+
+# The largest peak RSS (VmHWM, in KB) of process pid and its descendants, or
+# None if none of them has exec'd yet (or they're all gone). (wait4's ru_maxrss
+# can't be used: it counts the memory of the process that forked the child,
+# which the child has until it execs, and an exec'ing wrapper would still add
+# its own.)
+def peak_rss(pid):
+    best = None
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open('/proc/{}/cmdline'.format(p), 'rb') as f:
+                execd = f.read() != OWN_CMDLINE
+            if execd:
+                with open('/proc/{}/status'.format(p)) as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            kb = int(line.split()[1])
+                            best = kb if best is None else max(best, kb)
+            with open('/proc/{0}/task/{0}/children'.format(p)) as f:
+                stack += [int(c) for c in f.read().split()]
+        except (OSError, ValueError):
+            pass # already gone
+    return best
+
+# Run shell command cmd in cwd with `data` (bytes) on stdin. Returns (status,
+# stdout, stderr, seconds, peak RSS in KB), where status is the exit code, or
+# None if it timed out. The peak RSS is that of the largest process the command
+# ran, sampled every SAMPLE seconds while it runs (None if it was never seen).
+def run_cmd(cmd, data, cwd, timeout):
+    with tempfile.TemporaryFile() as fin, tempfile.TemporaryFile() as fout, \
+         tempfile.TemporaryFile() as ferr:
+        fin.write(data)
+        fin.seek(0)
+
+        start = time.perf_counter()
+        p = subprocess.Popen(cmd, shell=True, cwd=cwd, stdin=fin, stdout=fout,
+                             stderr=ferr, start_new_session=True)
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(p.pid, 9)
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+        rss = [None]
+        done = threading.Event()
+        def sample():
+            while not done.is_set():
+                rss[0] = max_known([rss[0], peak_rss(p.pid)])
+                done.wait(SAMPLE)
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+
+        p.wait()
+        seconds = time.perf_counter() - start
+        done.set()
+        timer.cancel()
+        sampler.join()
+
+        fout.seek(0)
+        ferr.seek(0)
+        return (None if timed_out else p.returncode, fout.read(), ferr.read(),
+                seconds, rss[0])
+
+# Run one repetition of a benchmark (the contents of file `path`, with args) on
+# a pipeline. Returns a dict of what happened.
+def run_one(conf, confdir, path, args, pipeline):
+    with open(path, 'rb') as f:
+        data = f.read()
+    (tmp, work) = make_workdir(confdir)
+    cmds = []
+    result = {'status': 'ok', 'commands': cmds}
+    try:
+        err = b''
+        for cmd in pipeline:
+            cmd = cmd.format(args=args)
+            (status, data, err, seconds, rss) = run_cmd(cmd, data, work,
+                                                        conf.get('timeout', 5))
+            cmds.append({'cmd': cmd, 'seconds': seconds, 'maxrss_kb': rss})
+            if status is None:
+                result['status'] = 'timeout'
+                break
+            if status != 0:
+                result['status'] = 'error'
+                result['stderr'] = err.decode(errors='replace')[-1000:]
+                break
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    result['seconds'] = sum([c['seconds'] for c in cmds])
+    result['maxrss_kb'] = max_known([c['maxrss_kb'] for c in cmds])
+    if result['status'] == 'ok':
+        result['output'] = data.decode(errors='replace')
+        text = err.decode(errors='replace')
+        m = re.search(conf['extract'], text)
+        result['value'] = None
+        if m:
+            v = m.group(1)
+            result['value'] = int(v) if v.isdigit() else v
+    return result
+
+# The args for a benchmark, from its `# ARGS:` line
+def bench_args(path):
+    with open(path) as f:
+        for line in f:
+            if line.startswith('# ARGS:'):
+                return line[len('# ARGS:'):].strip()
+    return ''
+
+# The largest of xs that isn't None (None if there's none)
+def max_known(xs):
+    return max([x for x in xs if x is not None], default=None)
+
+def mean_stdev(xs):
+    if not xs:
+        return (None, None)
+    return (statistics.mean(xs), statistics.stdev(xs) if len(xs) > 1 else 0.0)
+
+# Sum up the repetitions of one benchmark on one run. `baseline` is the output
+# of the baseline run, if there is one to compare against.
+def summarize(reps, baseline):
+    out = {'repetitions': [], 'result': None}
+    values = []
+    for r in reps:
+        if r['status'] != 'ok':
+            res = r['status'] if r['status'] == 'timeout' else 'missing'
+        elif baseline is not None and r['output'] != baseline:
+            res = 'incorrect'
+        elif r['value'] is None:
+            res = 'missing'
+        else:
+            res = r['value']
+            if isinstance(res, int):
+                values.append(res)
+        rep = {'result': res, 'seconds': r['seconds'], 'maxrss_kb': r['maxrss_kb'],
+               'commands': r['commands']}
+        if 'stderr' in r:
+            rep['stderr'] = r['stderr']
+        out['repetitions'].append(rep)
+
+    # The result is the value if every repetition agrees on it; otherwise the
+    # first thing that went wrong
+    results = [rep['result'] for rep in out['repetitions']]
+    bad = [x for x in results if x in ('timeout', 'missing', 'incorrect')]
+    if bad:
+        out['result'] = bad[0]
+    elif len(set(results)) > 1:
+        out['result'] = 'varies'
+    else:
+        out['result'] = results[0]
+
+    (out['value_mean'], out['value_stdev']) = mean_stdev(values)
+    (out['seconds_mean'], out['seconds_stdev']) = mean_stdev([r['seconds'] for r in reps])
+    out['maxrss_kb'] = max_known([r['maxrss_kb'] for r in reps])
+    commands = []
+    for i,c in enumerate(reps[0]['commands']):
+        times = [r['commands'][i]['seconds'] for r in reps if len(r['commands']) > i]
+        (m, s) = mean_stdev(times)
+        commands.append({'cmd': c['cmd'], 'seconds_mean': m, 'seconds_stdev': s,
+                         'maxrss_kb': max_known([r['commands'][i]['maxrss_kb']
+                                                 for r in reps if len(r['commands']) > i])})
+    out['commands'] = commands
+    return out
+
+def main():
+    argv = sys.argv[1:]
+    jobs = os.cpu_count() or 1
+    repeat = 1
+    results_file = None
+    config = None
+    while argv:
+        a = argv.pop(0)
+        if a == '-j':
+            jobs = int(argv.pop(0))
+        elif a == '-n':
+            repeat = int(argv.pop(0))
+        elif a == '-o':
+            results_file = argv.pop(0)
+        else:
+            config = a
+    if config is None:
+        print("usage: bench.py [-j JOBS] [-n REPEAT] [-o RESULTS.json] CONFIG.toml",
+              file=sys.stderr)
+        sys.exit(1)
+
+    with open(config, 'rb') as f:
+        conf = tomllib.load(f)
+    confdir = os.path.dirname(os.path.abspath(config))
+
+    benches = sorted(glob.glob(os.path.join(confdir, conf['benchmarks'])))
+    runs = conf['runs']
+
+    pool = ThreadPoolExecutor(jobs)
+    futures = {}
+    for path in benches:
+        args = bench_args(path)
+        for name,run in runs.items():
+            futures[(path, name)] = [pool.submit(run_one, conf, confdir, path, args,
+                                                 run['pipeline'])
+                                     for i in range(repeat)]
+
+    results = {}
+    print('benchmark,run,result')
+    for path in benches:
+        bench = os.path.splitext(os.path.basename(path))[0]
+        reps = {name: [f.result() for f in futures[(path, name)]] for name in runs}
+
+        baseline = None
+        if BASELINE in reps:
+            ok = [r for r in reps[BASELINE] if r['status'] == 'ok']
+            if ok:
+                baseline = ok[0]['output']
+
+        results[bench] = {}
+        for name in runs:
+            s = summarize(reps[name], baseline)
+            results[bench][name] = s
+            print('{},{},{}'.format(bench, name, s['result']))
+        sys.stdout.flush()
+
+    pool.shutdown()
+
+    if results_file:
+        with open(results_file, 'w') as f:
+            json.dump({'config': os.path.abspath(config), 'repeat': repeat,
+                       'jobs': jobs, 'benchmarks': results}, f, indent=1)
+
+if __name__ == '__main__':
+    main()
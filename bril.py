@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# One entry point for the tools in this repo, and one module to get at all of
+# their code from.
+#
+# usage: bril.py COMMAND [ARGS ...]
+#
+# where COMMAND is one of
+#   PASS [PASS ...]  run passes over a program (lvn, dce, to_ssa, licm, ...);
+#                    the same as pipeline.py PASS [PASS ...], so -c, --time
+#                    and --stats work too
+#   interp ARGS      interp.py: run a program (-p, --profile FILE)
+#   specop ARGS      11/specop.py: profile and form traces
+#   brilc ARGS       project/brilc: compile to LLVM
+#   bench ARGS       bench.py: run a brench config
+#   pipeline ARGS    pipeline.py
+#   server ARGS      server.py: keep the passes loaded for client.py
+#
+# Only the modules the command needs are imported, and nothing is imported
+# before the command is known; with --stats, the time to import them is
+# reported as counter `startup.seconds`.
+#
+# As a module, `import bril` is just as cheap: bril.ssa, bril.lvn, bril.interp,
+# etc. are imported on first use.
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+# Module name -> directory it lives in (relative to ROOT)
+MODULES = {
+    'analysis': '.', 'brilpy': '.', 'cache': '.', 'compactir': '.',
+    'dataflow': '.', 'dom': '.', 'gvn': '.', 'interp': '.', 'sccp': '.',
+    'ssa': '.', 'stats': '.', 'pipeline': '.', 'bench': '.', 'jsonstream': '.',
+    'server': '.', 'client': '.', 'brilbin': '.',
+    'lvn': '03', 'dce': '03', 'licm': '07', 'specop': '11',
+}
+
+# Command -> file whose main() runs it (relative to ROOT). Pass names are
+# handled by pipeline.py.
+COMMANDS = {
+    'interp':   'interp.py',
+    'specop':   '11/specop.py',
+    'brilc':    'project/brilc',
+    'bench':    'bench.py',
+    'pipeline': 'pipeline.py',
+    'server':   'server.py',
+}
+
+# Add ROOT/subdir to the import path. Lesson directories go at the end, so
+# shared modules always come from the top level (as in pipeline.load_pass).
+def add_path(subdir):
+    path = os.path.normpath(os.path.join(ROOT, subdir))
+    if path not in sys.path:
+        if subdir == '.':
+            sys.path.insert(0, path)
+        else:
+            sys.path.append(path)
+
+def __getattr__(name):
+    if name not in MODULES:
+        raise AttributeError("module 'bril' has no attribute '{}'".format(name))
+    import importlib
+    add_path(MODULES[name])
+    module = importlib.import_module(name)
+    globals()[name] = module
+    return module
+
+# Import the file for a command as a module (brilc has no .py, so it's loaded
+# by path)
+def load_command(path):
+    import importlib.machinery
+    import importlib.util
+    name = os.path.splitext(os.path.basename(path))[0]
+    add_path(os.path.dirname(path) or '.')
+    loader = importlib.machinery.SourceFileLoader(name, os.path.join(ROOT, path))
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def usage():
+    print("usage: bril.py COMMAND [ARGS ...]\n"
+          "commands: PASS [PASS ...], {}".format(', '.join(COMMANDS)),
+          file=sys.stderr)
+    sys.exit(1)
+
+def main():
+    if len(sys.argv) < 2:
+        usage()
+
+    import time
+    start = time.perf_counter()
+
+    cmd = sys.argv[1]
+    if cmd in COMMANDS:
+        path = COMMANDS[cmd]
+        args = sys.argv[2:]
+    else:
+        # passes (or pipeline.py's flags)
+        path = COMMANDS['pipeline']
+        args = sys.argv[1:]
+
+    add_path('.')
+    import stats
+    module = load_command(path)
+    seconds = time.perf_counter() - start
+
+    # Each tool gets the argv it would have had on its own (--stats works
+    # for all of them)
+    sys.argv = [os.path.join(ROOT, path)] + stats.flag(args)
+    stats.add('startup.seconds', seconds)
+    module.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# A binary format for bril programs, about a fifth the size of the JSON, in
+# which each function can be found and decoded on its own.
+#
+# usage: brilbin.py [-d]  < prog.json > prog.bin  (or the other way, with -d)
+#
+# The input may be in either format; the output is binary, or JSON with -d.
+# Tools that read programs (the passes, pipeline.py, interp.py, brilc) take
+# either format too, and the passes write binary when given --bin (see flag).
+#
+# A file is
+#
+#   MAGIC
+#   a blob for each function
+#   a blob for the rest of the program (an object of the top-level keys other
+#     than "functions", e.g. "structs")
+#   the index: (number of functions + 1) offsets, where each blob starts
+#   the number of functions and the offset of the index
+#
+# where offsets are little-endian u64s from the start of the file. Since the
+# index is at the end, a program can be written a function at a time.
+#
+# A blob is a JSON value on its own: its strings (each distinct one once,
+# numbered in order of first use), its object shapes (the list of keys of each
+# distinct kind of object, e.g. of a const instruction), then the value. All
+# numbers are varints: 7 bits a byte, low bits first, high bit set on all but
+# the last byte. Each value starts with a tag byte:
+#
+#   NULL, FALSE, TRUE
+#   INT n        (zigzag-coded, so small negative numbers stay small)
+#   FLOAT        8 bytes, a little-endian double
+#   STR i        the ith string
+#   LIST n v...
+#   STRS n i...  a list of n strings (args, labels, funcs), without tags
+#   OBJ s v...   an object of shape s: one value for each of its keys
+#
+# Since a blob doesn't refer to anything outside itself, its bytes can be used
+# as they are: Program.blob() gets them without decoding anything (e.g., for
+# a cache key), and a Writer writes them back out unchanged.
+#
+# Loading (load) maps the file into memory when it can, and decodes nothing:
+# only the functions asked for, when they're asked for.
+
+import io
+import json
+import mmap
+import struct
+import sys
+from itertools import islice
+
+MAGIC = b'\x89BRIL\r\n\x00'
+
+(NULL, FALSE, TRUE, INT, FLOAT, STR, LIST, STRS, OBJ) = range(9)
+
+_double = struct.Struct('<d')
+_trailer = struct.Struct('<QQ')
+
+# Set by flag(): whether tools write binary instead of JSON
+WRITE_BINARY = False
+
+class FormatError(ValueError):
+    pass
+
+# Turn binary output on if argv has --bin. Returns argv without it.
+def flag(argv):
+    global WRITE_BINARY
+    if '--bin' in argv:
+        WRITE_BINARY = True
+        argv = [a for a in argv if a != '--bin']
+    return argv
+
+# The blob for a JSON value
+def encode(value):
+    strings = {}
+    shapes = {}
+    body = bytearray()
+    append = body.append
+
+    # (most of the time in here goes to these, so the common cases are inlined:
+    # one-byte numbers, values of exact types)
+    def number(n):
+        while n >= 0x80:
+            append((n & 0x7f) | 0x80)
+            n >>= 7
+        append(n)
+
+    def string(s):
+        i = strings.get(s)
+        if i is None:
+            i = strings[s] = len(strings)
+        if i < 0x80:
+            append(i)
+        else:
+            number(i)
+
+    def strs(v):
+        append(STRS)
+        number(len(v))
+        for x in v:
+            string(x)
+
+    def enc(v):
+        t = type(v)
+        if t is str:
+            append(STR)
+            string(v)
+        elif t is dict:
+            keys = tuple(v)
+            i = shapes.get(keys)
+            if i is None:
+                i = shapes[keys] = len(shapes)
+            append(OBJ)
+            number(i)
+            for x in v.values():
+                if type(x) is str:
+                    append(STR)
+                    string(x)
+                else:
+                    enc(x)
+        elif t is list:
+            if v and all(type(x) is str for x in v):
+                strs(v)
+            else:
+                append(LIST)
+                number(len(v))
+                for x in v:
+                    enc(x)
+        elif t is bool:
+            append(TRUE if v else FALSE)
+        elif t is int:
+            append(INT)
+            number(2 * v if v >= 0 else -2 * v - 1)
+        elif v is None:
+            append(NULL)
+        elif t is float:
+            append(FLOAT)
+            body.extend(_double.pack(v))
+        else:
+            # (subclasses of the above)
+            for base in (str, list, int, float):
+                if isinstance(v, base):
+                    enc(base(v))
+                    break
+            else:
+                # e.g., a compactir.Instr
+                enc(dict(v))
+
+    enc(value)
+
+    # Shape keys are strings too, so they're numbered before the string table
+    # is written
+    shape_keys = []
+    for keys in shapes:
+        shape_keys.append([strings.setdefault(k, len(strings)) for k in keys])
+
+    out = bytearray()
+    append = out.append
+    number(len(strings))
+    for k in strings:
+        b = k.encode()
+        number(len(b))
+        out.extend(b)
+    number(len(shape_keys))
+    for keys in shape_keys:
+        number(len(keys))
+        for k in keys:
+            number(k)
+    out.extend(body)
+    return bytes(out)
+
+# The JSON value in a blob
+def decode(blob):
+    pos = 0
+
+    def varint():
+        nonlocal pos
+        n = 0
+        shift = 0
+        while True:
+            b = blob[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    try:
+        strings = []
+        for i in range(varint()):
+            n = varint()
+            strings.append(str(blob[pos:pos + n], 'utf-8'))
+            pos += n
+        shapes = []
+        for i in range(varint()):
+            shapes.append([strings[varint()] for j in range(varint())])
+    except IndexError:
+        raise FormatError("truncated blob")
+
+    # The values are most of a blob, so they're read from an iterator, which is
+    # much faster than indexing
+    nx = iter(islice(blob, pos, None)).__next__
+
+    def number():
+        n = nx()
+        if n < 0x80:
+            return n
+        n &= 0x7f
+        shift = 7
+        while True:
+            b = nx()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def value():
+        tag = nx()
+        if tag == OBJ:
+            return {k: value() for k in shapes[number()]}
+        if tag == STR:
+            return strings[number()]
+        if tag == STRS:
+            return [strings[number()] for i in range(number())]
+        if tag == LIST:
+            return [value() for i in range(number())]
+        if tag == INT:
+            n = number()
+            return (n >> 1) ^ -(n & 1)
+        if tag == FLOAT:
+            return _double.unpack(bytes([nx() for i in range(8)]))[0]
+        if tag <= TRUE:
+            return (None, False, True)[tag]
+        raise FormatError("bad tag {}".format(tag))
+
+    try:
+        return value()
+    except (StopIteration, IndexError):
+        raise FormatError("truncated blob")
+
+
+class Program:
+    """ A binary program in memory (bytes, or a mmap of the file): its
+    functions are only decoded when asked for. """
+    def __init__(self, data):
+        self.data = data
+        if len(data) < len(MAGIC) + _trailer.size or data[:len(MAGIC)] != MAGIC:
+            raise FormatError("not a binary bril program")
+        (n, index) = _trailer.unpack_from(data, len(data) - _trailer.size)
+        if index + 8 * (n + 1) + _trailer.size != len(data):
+            raise FormatError("bad index")
+        self.offsets = struct.unpack_from('<{}Q'.format(n + 1), data, index)
+        self.index = index
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # The bytes of the ith function's blob
+    def blob(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def function(self, i):
+        return decode(self.blob(i))
+
+    # The top-level keys other than "functions"
+    def other(self):
+        return decode(self.data[self.offsets[-1]:self.index])
+
+    # The whole program, as json.load would give it
+    def to_dict(self):
+        prog = {'functions': [self.function(i) for i in range(len(self))]}
+        prog.update(self.other())
+        return prog
+
+
+class Writer:
+    """ Writes a binary program to binary stream f, a function at a time.
+    Call function() (or blob(), with one from Program.blob) for each
+    function, then close() with the other top-level keys. """
+    def __init__(self, f):
+        self.f = f
+        self.f.write(MAGIC)
+        self.offsets = []
+        self.pos = len(MAGIC)
+
+    def blob(self, b):
+        self.offsets.append(self.pos)
+        self.f.write(b)
+        self.pos += len(b)
+
+    def function(self, func):
+        self.blob(encode(func))
+
+    def close(self, other={}):
+        n = len(self.offsets)
+        self.blob(encode(dict(other)))
+        self.f.write(struct.pack('<{}Q'.format(n + 1), *self.offsets))
+        self.f.write(_trailer.pack(n, self.pos))
+        self.f.flush()
+
+
+# The binary stream under text stream f (flushed, so the two can be mixed)
+def binary_stream(f):
+    f.flush()
+    return f.buffer
+
+# Is the program in text stream f binary? (Looks without reading anything.)
+def is_binary(f):
+    buf = getattr(f, 'buffer', None)
+    return buf is not None and hasattr(buf, 'peek') and buf.peek(1)[:1] == MAGIC[:1]
+
+# The binary Program in text stream f: mapped into memory if f is a file (and
+# nothing has been read from it yet), else read.
+def load(f):
+    buf = f.buffer
+    try:
+        if buf.seekable() and buf.tell() == 0:
+            return Program(mmap.mmap(buf.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError, io.UnsupportedOperation):
+        pass
+    return Program(buf.read())
+
+# Read a whole program, in either format, from text stream f (default: stdin)
+def read_program(f=None):
+    f = sys.stdin if f is None else f
+    if is_binary(f):
+        return load(f).to_dict()
+    return json.load(f)
+
+# Write prog to text stream f (default: stdout): binary if WRITE_BINARY, else
+# JSON (with `default` for values json doesn't know, as for json.dumps)
+def write_program(prog, f=None, default=None):
+    f = sys.stdout if f is None else f
+    if WRITE_BINARY:
+        w = Writer(binary_stream(f))
+        for func in prog['functions']:
+            w.function(func)
+        w.close({k: v for (k, v) in prog.items() if k != 'functions'})
+    else:
+        f.write(json.dumps(prog, default=default))
+
+def main():
+    argv = sys.argv[1:]
+    if '-d' not in argv:
+        flag(['--bin'])
+    write_program(read_program())
+
+if __name__ == '__main__':
+    main()
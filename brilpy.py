@@ -3,7 +3,7 @@
 # Mark Moeller:
 
 import json
-import sys
+from dataflow import Analysis, solve
 
 TERM = 'jmp', 'br', 'ret'
 
@@ -75,7 +75,8 @@ class CFG:
                 for label in block[-1]['labels']:
                     make_edge(i, label)
 
-            elif 'op' in block[-1] and block[-1]['op'] != 'ret':
+            # Anything else falls through, including a block that's just a label
+            elif block[-1].get('op') != 'ret':
                 self.edges[i] = [i+1]
 
         self.n = len(self.names)
@@ -101,6 +102,7 @@ class CFG:
     # previsit and posvisit of i, respectively.
     # next_tree is called with no args after each time dfs_visit finishes a
     # connected component.
+    # (Uses an explicit stack, so deep graphs don't hit the recursion limit.)
     def dfs(self, order=None, pre=None, post=None, next_tree=None, edges=None):
 
         if not order:
@@ -113,19 +115,32 @@ class CFG:
         GRAY = 1
         BLACK = 2
 
-        visited = []
         colors = [WHITE] * self.n
 
         def dfs_visit(node):
-            if colors[node] == WHITE:
-                colors[node] = GRAY
-                if pre:
-                    pre(node)
-                for v in edges[node]:
-                    dfs_visit(v)
-                colors[node] = BLACK
-                if post:
-                    post(node)
+            if colors[node] != WHITE:
+                return
+            colors[node] = GRAY
+            if pre:
+                pre(node)
+
+            # stack of (node, index of the next successor to visit)
+            stack = [(node, 0)]
+            while stack:
+                (u, k) = stack[-1]
+                if k < len(edges[u]):
+                    stack[-1] = (u, k + 1)
+                    v = edges[u][k]
+                    if colors[v] == WHITE:
+                        colors[v] = GRAY
+                        if pre:
+                            pre(v)
+                        stack.append((v, 0))
+                else:
+                    stack.pop()
+                    colors[u] = BLACK
+                    if post:
+                        post(u)
 
         for i in order:
             dfs_visit(i)
@@ -133,56 +148,16 @@ class CFG:
                 next_tree()
 
     # Return the indeces in reverse-post-order 
-    def rpo(self):
+    # order: as for dfs(); e.g., [0] for only the blocks reachable from entry
+    def rpo(self, order=None):
         visited = []
         def post_visit(i):
             visited.append(i)
 
-        self.dfs(post=post_visit)
+        self.dfs(order=order, post=post_visit)
         visited.reverse()
         return visited
 
-    # Unused first attempt. Computes SCCs in the graph.
-    def natural_loops(self):
-
-        sccs = []
-        cur = []
-
-        def postv(i):
-            nonlocal cur
-            cur.append(i)
-
-        def nt():
-            nonlocal cur
-            if cur:
-                sccs.append(cur)
-                cur = []
-
-        self.dfs(order=self.rpo(), post=postv, next_tree=nt, edges=self.preds)
-
-        nl_list = []
-
-        for cand in sccs:
-            if len(cand) > 1:
-                nat = True
-                header = -1
-                for b in cand:
-                    for p in self.preds[b]:
-                        if p not in cand:
-                            if header == -1:
-                                header = b
-                            else:
-                                nat = False
-                                break
-                if nat:
-                    cand.remove(header)
-                    nl_list.append([header] + cand)
-
-        return nl_list
-
-
-
-
     def to_dot(self):
         s = "digraph g {\n"
 
@@ -198,84 +173,172 @@ class CFG:
             print("{} {}".format(i, n))
 
 # ------------------------------------------------------------------------------
-# Dataflow functions for SSA Reaching Definitions
-#   Since we assume SSA, we can map from varname->single block defining
+# Loop forest
+#
+# The natural loops of a CFG, nested by containment. Loops with the same header
+# are one loop. Built from the dominator tree the way LLVM's LoopInfo does it:
+# headers are visited in postorder of the dominator tree (so inner loops come
+# first), and each loop is found by walking backwards from its latches. When
+# the walk reaches a block already in an inner loop, it skips straight to that
+# loop's outermost known ancestor, which becomes a child of the new loop, and
+# continues from that ancestor's header. Each edge is walked about once per
+# loop that gets discovered through it, rather than once per enclosing loop.
 # ------------------------------------------------------------------------------
 
-def rd_init(func, graph):
-    in_b = []
-    out_b = []
-
-    in_b.append({})
-    out_b.append({})
-
-    if 'args' in func:
-        for arg in func['args']:
-            in_b[0][arg['name']] = 0
-
-    for i in range(graph.n - 1):
-        in_b.append({})
-        out_b.append({})
-    return (in_b, out_b)
-
-
-def rd_xfer(in_b, block, idx):
-
-    out_b = in_b.copy()
-
-    for i,inst in enumerate(block):
-        if 'dest' in inst:
-            if inst['dest'] in out_b and out_b[inst['dest']] != idx:
-                print("warning: illegal redef of var `{}`.".format(inst['dest'])
-                + "This function assumes SSA.", file=sys.stderr)
-            out_b[inst['dest']] = idx
-
-    return out_b
-
-def rd_merge(pred_list):
-
-    result = {}
+class Loop:
+    """ A natural loop.
+    header: block idx of the header
+    latches: blocks with a back edge to the header
+    body: bit vector (int) of the blocks in the loop, including the header and
+          the blocks of nested loops
+    parent: the innermost loop containing this one, or None
+    children: the loops immediately nested in this one
+    depth: nesting depth (1 for an outermost loop)
+    """
+    def __init__(self, header, g):
+        self.header = header
+        self.g = g
+        self.latches = []
+        self.body = 0
+        self.parent = None
+        self.children = []
+        self.depth = 1
+        self._exits = None
+
+    def __contains__(self, b):
+        return (self.body >> b) & 1 == 1
+
+    # The block idxs of the loop, in increasing order
+    def blocks(self):
+        result = []
+        bits = self.body
+        while bits:
+            low = bits & -bits
+            result.append(low.bit_length() - 1)
+            bits ^= low
+        return result
+
+    # The blocks of the loop with an edge leaving it (computed on first use)
+    def exits(self):
+        if self._exits is None:
+            self._exits = [b for b in self.blocks()
+                           if any(s not in self for s in self.g.edges[b])]
+        return self._exits
+
+
+class LoopForest:
+    """ The loops of a CFG.
+    loops: every loop, innermost first (a loop always comes after the loops
+           nested in it)
+    roots: the outermost loops
+    loop_of: block idx -> innermost loop containing it, or None
+    """
+    # g: a CFG; doms: its dom.Dominators
+    def __init__(self, g, doms):
+        self.loops = []
+        self.roots = []
+        self.loop_of = [None] * g.n
+
+        # postorder of the dominator tree
+        headers = []
+        stack = [(0, 0)]
+        while stack:
+            (u, k) = stack[-1]
+            children = doms.dom_tree.get(u, [])
+            if k < len(children):
+                stack[-1] = (u, k + 1)
+                stack.append((children[k], 0))
+            else:
+                stack.pop()
+                headers.append(u)
+
+        for h in headers:
+            latches = [p for p in g.preds[h] if doms.dominates(h, p)]
+            if not latches:
+                continue
+
+            loop = Loop(h, g)
+            loop.latches = latches
+            self.loops.append(loop)
+            self.loop_of[h] = loop
+            own = 1 << h
+
+            work = [p for p in latches if p != h]
+            while work:
+                b = work.pop()
+                sub = self.loop_of[b]
+                if sub is None:
+                    if doms.pre[b] is None:
+                        continue # unreachable
+                    self.loop_of[b] = loop
+                    own |= 1 << b
+                    work.extend(g.preds[b])
+                else:
+                    while sub.parent is not None:
+                        sub = sub.parent
+                    if sub is loop:
+                        continue
+                    sub.parent = loop
+                    loop.children.append(sub)
+                    work.extend([p for p in g.preds[sub.header]
+                                 if not doms.dominates(sub.header, p)])
+
+            loop.body = own
+
+        # loops come after their children, so by the time each is reached its
+        # body is complete
+        for loop in self.loops:
+            if loop.parent is None:
+                self.roots.append(loop)
+            else:
+                loop.parent.body |= loop.body
 
-    for p in pred_list:
-        for k,v in p.items():
-            if k in result and v != result[k]:
-                print("warning: illegal redef of var `{}` (multiple blocks).".format(v) +
-                        " This function assumes SSA.", file=sys.stderr)
-            result[k] = v
-    
-    return result
+        for loop in reversed(self.loops):
+            if loop.parent is not None:
+                loop.depth = loop.parent.depth + 1
 
 
+    # Nesting depth of block b (0 if it's in no loop)
+    def depth(self, b):
+        return self.loop_of[b].depth if self.loop_of[b] else 0
 
 # ------------------------------------------------------------------------------
 # Worklist function
 # func: the function object (as loaded from json)
 # init: (func, graph) -> (in_b, out_b): Computes initial datastructures. in_b
 #                                       and out_b are each arrays of size
-#                                       len(blocks).
-# xfer: (in_b, block) -> out_b:         Compute transfer for a single block.
+#                                       len(blocks). in_b[0] is the fact
+#                                       entering the function; out_b[0] is
+#                                       used as the initial fact everywhere.
+# xfer: (in_b, block, idx) -> out_b:    Compute transfer for a single block.
 # merge: List of out_b -> in_b:         Given a list of predecessors' out_b's,
 #                                       compute a single in_b.
+# graph: the CFG of func, if already computed
+#
+# This is kept for analyses written against the callback interface above; new
+# analyses should subclass dataflow.Analysis (or BitVectorAnalysis) directly.
 # ------------------------------------------------------------------------------
 
-def run_worklist(func, init, xfer, merge):
-    graph = CFG(func)
-
-    (in_b, out_b) = init(func, graph)
-
-    worklist = list(range(graph.n))
-
-    while worklist:
-        b = worklist[0]
-        worklist = worklist[1:]
+class _CallbackAnalysis(Analysis):
+    def __init__(self, func, graph, init, xfer, merge):
+        (in_b, out_b) = init(func, graph)
+        self.entry = in_b[0]
+        self.initial = out_b[0]
+        self.blocks = graph.blocks
+        self.xfer = xfer
+        self.meet = merge
 
-        in_b[b] = merge([out_b[x] for x in graph.preds[b]]) if graph.preds[b] else {}
+    def boundary(self):
+        return self.entry
 
-        out_b_copy = out_b[b].copy()
+    def top(self):
+        return self.initial
 
-        out_b[b] = xfer(in_b[b], graph.blocks[b], b)
+    def transfer(self, b, fact):
+        return self.xfer(fact, self.blocks[b], b)
 
-        if out_b[b] != out_b_copy:
-            worklist += graph.edges[b]
+def run_worklist(func, init, xfer, merge, graph=None):
+    if graph is None:
+        graph = CFG(func)
 
-    return (in_b, out_b)
+    return solve(graph, _CallbackAnalysis(func, graph, init, xfer, merge))
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# A content-addressed on-disk cache of per-function results, so that running
+# the same tool over the same functions again (e.g., in a brench run, or after
+# editing one function of a big program) only redoes the functions that
+# changed.
+#
+# Caching is turned on by setting BRIL_CACHE to a directory. Each entry is
+# keyed by a sha256 of
+#   - the canonical JSON of the function (sorted keys, no whitespace),
+#   - the name of what was run on it (a pass pipeline, or "brilc"),
+#   - anything else the result depends on (e.g., struct definitions), and
+#   - the tool version: a hash of the source of every module of this repo
+#     loaded in the process, so editing a pass invalidates what it produced.
+# The value is the text of the result (the optimized function's JSON, with keys
+# in the order the tool wrote them, or its LLVM), or for a tool writing binary
+# programs, the function's blob (see brilbin.py). Entries live in
+# BRIL_CACHE/<first 2 hex digits of key>/<rest of key>.
+#
+# A hit touches the entry's mtime, which makes it the last-use time for LRU:
+# once the directory grows past BRIL_CACHE_SIZE (in MB, default 256), the
+# least recently used entries are deleted until it fits again.
+#
+# Only functions a tool transforms on their own, without looking at the rest
+# of the program, can be cached this way; see run_cached.
+#
+# Hits and misses are counted in stats counters `cache.hits` and
+# `cache.misses`.
+#
+# Every tool imports this, and most runs have caching off, so hashlib and
+# tempfile (a good part of a tool's startup time) are only imported once
+# they're needed.
+
+import json
+import os
+import sys
+import stats
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+DEFAULT_SIZE = 256 # MB
+
+# The canonical JSON text of a bril value (instructions in compact form are
+# written as their dicts)
+def canonical(x):
+    return json.dumps(x, sort_keys=True, separators=(',', ':'), default=dict)
+
+_version = None
+
+# Hash of the source of the loaded modules that are part of this repo (plus the
+# script being run)
+def tool_version():
+    global _version
+    if _version is None:
+        import hashlib
+        paths = set()
+        for m in list(sys.modules.values()):
+            f = getattr(m, '__file__', None)
+            if f:
+                f = os.path.realpath(f)
+                if f.startswith(ROOT + os.sep) and os.path.isfile(f):
+                    paths.add(f)
+        h = hashlib.sha256()
+        for f in sorted(paths):
+            h.update(os.path.relpath(f, ROOT).encode())
+            with open(f, 'rb') as src:
+                h.update(hashlib.sha256(src.read()).digest())
+        _version = h.hexdigest()
+    return _version
+
+
+class Cache:
+    """ A directory of cached results, with at most `limit` bytes in it. """
+    def __init__(self, directory, limit=DEFAULT_SIZE * 2**20):
+        self.directory = directory
+        self.limit = limit
+
+    # Key for the result of running `tool` on func. `extra`: anything else the
+    # result depends on. func may also be given as bytes: the function's blob
+    # in a binary program (see brilbin.py).
+    def key(self, func, tool, extra=None):
+        import hashlib
+        h = hashlib.sha256()
+        if isinstance(func, bytes):
+            h.update(b'binary\0' + func + b'\0')
+            parts = (tool, canonical(extra), tool_version())
+        else:
+            parts = (canonical(func), tool, canonical(extra), tool_version())
+        for part in parts:
+            h.update(part.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    # The cached text for key (bytes if binary), or None
+    def get(self, key, binary=False):
+        p = self.path(key)
+        try:
+            with open(p, 'rb' if binary else 'r') as f:
+                text = f.read()
+        except OSError:
+            stats.add('cache.misses')
+            return None
+        try:
+            os.utime(p)
+        except OSError:
+            pass # evicted by someone else in the meantime; it's still a hit
+        stats.add('cache.hits')
+        return text
+
+    # Store text (or bytes) under key. The entry is written to a temp file and
+    # renamed into place, so other processes never see half of it.
+    def put(self, key, text):
+        d = os.path.dirname(self.path(key))
+        try:
+            import tempfile
+            os.makedirs(d, exist_ok=True)
+            (fd, tmp) = tempfile.mkstemp(dir=d, prefix='.tmp')
+            with os.fdopen(fd, 'wb' if isinstance(text, bytes) else 'w') as f:
+                f.write(text)
+            os.replace(tmp, self.path(key))
+        except OSError as e:
+            print("warning: couldn't write to cache {}: {}".format(self.directory,
+                  e), file=sys.stderr)
+
+    # Delete least recently used entries until the cache fits in its limit
+    def trim(self):
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        total = 0
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+
+        if total <= self.limit:
+            return
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# The Cache named by the environment (BRIL_CACHE, BRIL_CACHE_SIZE), or None if
+# caching is off
+def from_env():
+    directory = os.environ.get('BRIL_CACHE')
+    if not directory:
+        return None
+    size = float(os.environ.get('BRIL_CACHE_SIZE', DEFAULT_SIZE))
+    return Cache(directory, int(size * 2**20))
+
+# Run `run` (which takes a program and returns it transformed, treating each
+# function on its own) on prog, reusing the cached result for each function it
+# has been run on before under the name `tool`. Only the functions that miss
+# are passed to `run`, and their results are added to the cache. With trim
+# False, the caller trims the cache itself (e.g., once after many calls).
+def run_cached(prog, tool, run, cache=None, trim=True):
+    if cache is None:
+        cache = from_env()
+    if cache is None:
+        return run(prog)
+
+    extra = prog.get('structs')
+    keys = [cache.key(func, tool, extra) for func in prog['functions']]
+    results = [cache.get(k) for k in keys]
+
+    todo = [func for (func, r) in zip(prog['functions'], results) if r is None]
+    if todo:
+        sub = dict(prog)
+        sub['functions'] = todo
+        done = iter(run(sub)['functions'])
+    funcs = []
+    for (k, r) in zip(keys, results):
+        if r is None:
+            func = next(done)
+            cache.put(k, json.dumps(func, default=dict))
+        else:
+            func = json.loads(r)
+        funcs.append(func)
+
+    prog['functions'] = funcs
+    if trim:
+        cache.trim()
+    return prog
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# Client for server.py: a drop-in replacement for pipeline.py that has the
+# server run the passes, so a pipeline stage costs little more than starting
+# python.
+#
+# usage: client.py [-c] [--time] [--stats] PASS [PASS ...]  < prog.json > out.json
+#
+# Output, messages and exit status are those pipeline.py would have given. If
+# no server is listening (on $BRIL_SERVER, or $TMPDIR/bril-server-<uid>.sock),
+# the passes are run here, in this process, instead.
+#
+# This is the part that runs for every stage, so it imports as little as it
+# can: not json, and not even socket (which brings in enum and selectors, and
+# takes longer to import than the request takes), just the _socket it wraps.
+
+import _socket
+import os
+import sys
+
+# Environment variables the server should see as the client has them
+ENV = 'BRIL_STATS', 'BRIL_CACHE', 'BRIL_CACHE_SIZE'
+
+def socket_path():
+    path = os.environ.get('BRIL_SERVER')
+    if path:
+        return path
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                        'bril-server-{}.sock'.format(os.getuid()))
+
+# Send a request to the server listening on `path`: run pipeline.py with args
+# (a list of strings) on data (bytes). Returns (exit status, stdout, stderr),
+# the last two as bytes. Raises OSError if there's no server.
+#
+# The request is one line of NUL-separated fields (the working directory, the
+# values of ENV, then args) followed by the program; the client then closes
+# its side. The reply is a line "STATUS LEN", LEN bytes of stderr, and then
+# stdout up to the end.
+def request(path, args, data):
+    s = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        fields = [os.getcwd()] + [os.environ.get(v, '') for v in ENV] + args
+        s.sendall('\0'.join(fields).encode() + b'\n' + data)
+        s.shutdown(_socket.SHUT_WR)
+
+        chunks = []
+        while True:
+            chunk = s.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        s.close()
+
+    reply = b''.join(chunks)
+    (line, _, rest) = reply.partition(b'\n')
+    (status, n) = line.split()
+    n = int(n)
+    return (int(status), rest[n:], rest[:n])
+
+def main():
+    args = sys.argv[1:]
+    data = sys.stdin.buffer.read()
+    try:
+        (status, out, err) = request(socket_path(), args, data)
+    except (OSError, ValueError):
+        # No server (or it went away mid-request): run the passes here
+        import io
+        sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+        import pipeline
+        sys.stdin = io.TextIOWrapper(io.BufferedReader(io.BytesIO(data)),
+                                     encoding='utf-8')
+        pipeline.main()
+        return
+
+    sys.stdout.buffer.write(out)
+    sys.stderr.buffer.write(err)
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# A compact in-memory form for bril instructions.
+#
+# Each instruction is an Instr, a __slots__ object holding its opcode as a
+# small int (an index into OPCODES) and its dest and args as ids into a
+# Numbering of the program's variable names, instead of a dict with string
+# keys. An Instr still behaves like the dict it came from (inst['op'],
+# 'dest' in inst, inst['args'] = [...], inst.get(...), ...), so brilpy.CFG,
+# form_blocks and the passes run on it unchanged, and new instructions they
+# create as plain dicts can sit alongside Instrs in a function.
+#
+#   prog = load(sys.stdin)   # instructions become Instrs as they're parsed
+#   ...
+#   dump(prog, sys.stdout)   # same JSON as the plain form
+#
+# Conversion is lossless: keys an Instr has no slot for are kept in `extra`.
+
+import json
+from collections.abc import MutableMapping
+from dataflow import Numbering
+
+# Opcode numbers; unknown opcodes are appended as they're seen
+OPCODES = ['const', 'id', 'add', 'mul', 'sub', 'div', 'eq', 'lt', 'gt', 'le',
+           'ge', 'not', 'and', 'or', 'jmp', 'br', 'call', 'ret', 'print',
+           'nop', 'phi', 'alloc', 'free', 'store', 'load', 'ptradd', 'getmbr',
+           'isnull']
+OPCODE = {op: i for i,op in enumerate(OPCODES)}
+
+def opcode(op):
+    if op not in OPCODE:
+        OPCODE[op] = len(OPCODES)
+        OPCODES.append(op)
+    return OPCODE[op]
+
+# The keys of an instruction, in the order they're written out
+KEYS = ('label', 'dest', 'type', 'op', 'args', 'funcs', 'labels', 'value')
+
+ABSENT = object()
+
+
+class Instr(MutableMapping):
+
+    __slots__ = ('names', 'opcode', 'dest', 'type', 'args', 'funcs', 'labels',
+                 'value', 'label', 'extra')
+
+    # names: the Numbering of variable names shared by the whole program
+    # d: the plain (dict) form of the instruction
+    def __init__(self, names, d=None):
+        self.names = names
+        self.opcode = None
+        self.dest = None
+        self.type = None
+        self.args = None
+        self.funcs = None
+        self.labels = None
+        self.value = ABSENT
+        self.label = None
+        self.extra = None
+        if d:
+            for k,v in d.items():
+                self[k] = v
+
+    def __contains__(self, key):
+        if key == 'op':
+            return self.opcode is not None
+        elif key == 'dest':
+            return self.dest is not None
+        elif key == 'args':
+            return self.args is not None
+        elif key == 'value':
+            return self.value is not ABSENT
+        elif key in KEYS:
+            return getattr(self, key) is not None
+        return self.extra is not None and key in self.extra
+
+    def __getitem__(self, key):
+        if key == 'op':
+            if self.opcode is not None:
+                return OPCODES[self.opcode]
+        elif key == 'dest':
+            if self.dest is not None:
+                return self.names.items[self.dest]
+        elif key == 'args':
+            if self.args is not None:
+                items = self.names.items
+                return [items[a] for a in self.args]
+        elif key == 'value':
+            if self.value is not ABSENT:
+                return self.value
+        elif key in KEYS:
+            v = getattr(self, key)
+            if v is not None:
+                return v
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, v):
+        if key == 'op':
+            self.opcode = opcode(v)
+        elif key == 'dest':
+            self.dest = self.names.id(v)
+        elif key == 'args':
+            self.args = tuple([self.names.id(a) for a in v])
+        elif key in KEYS:
+            setattr(self, key, v)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = v
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key == 'op':
+            self.opcode = None
+        elif key == 'value':
+            self.value = ABSENT
+        elif key in KEYS:
+            setattr(self, key, None)
+        else:
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+
+    def __iter__(self):
+        for k in KEYS:
+            if k in self:
+                yield k
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return 'Instr({})'.format(dict(self))
+
+    # Instrs, like the objects in a json tree, compare by identity
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+
+# Return the plain (dict) form of the instruction
+def to_dict(inst):
+    return dict(inst) if isinstance(inst, Instr) else inst
+
+# Convert a program in plain form to the compact form, in place
+def from_json(prog):
+    names = Numbering()
+    for func in prog['functions']:
+        func['instrs'] = [Instr(names, i) for i in func['instrs']]
+    return prog
+
+# Convert a program in compact form (or a mix of the two) back to plain form,
+# in place
+def to_json(prog):
+    for func in prog['functions']:
+        func['instrs'] = [to_dict(i) for i in func['instrs']]
+    return prog
+
+# Read a program from a file, building Instrs directly as it's parsed (so the
+# plain dicts for instructions never all exist at once)
+def load(f):
+    names = Numbering()
+
+    def hook(d):
+        if 'op' in d or ('label' in d and isinstance(d['label'], str)):
+            return Instr(names, d)
+        return d
+
+    return json.load(f, object_hook=hook)
+
+def dump(prog, f):
+    json.dump(prog, f, default=to_dict)
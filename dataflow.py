@@ -0,0 +1,349 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# A dataflow framework for forward and backward analyses over a brilpy.CFG.
+#
+# Blocks are taken off the worklist in reverse postorder (forward analyses) or
+# postorder (backward analyses) using a priority queue that holds each block at
+# most once, so most blocks are visited only once per pass over a loop.
+#
+# Analyses over sets of variables or definitions should use BitVectorAnalysis:
+# each element gets a dense integer id (see Numbering) and facts are Python
+# ints used as bit vectors, so transfer and meet are a few int operations
+# rather than set/dict copies.
+
+import heapq
+import sys
+import stats
+
+class Numbering:
+    """ Dense integer ids for hashable items (variable names, definitions, ...)
+    ids: item -> id
+    items: id -> item
+    """
+    def __init__(self, items=()):
+        self.ids = {}
+        self.items = []
+        for x in items:
+            self.id(x)
+
+    # Return the id of x, assigning the next one if x is new
+    def id(self, x):
+        i = self.ids.get(x)
+        if i is None:
+            i = len(self.items)
+            self.ids[x] = i
+            self.items.append(x)
+        return i
+
+    def __len__(self):
+        return len(self.items)
+
+    # Bit vector with the bits of the given items set
+    def bits(self, xs):
+        result = 0
+        for x in xs:
+            result |= 1 << self.id(x)
+        return result
+
+    # List of the items whose bits are set in `bits`
+    def members(self, bits):
+        result = []
+        while bits:
+            low = bits & -bits
+            result.append(self.items[low.bit_length() - 1])
+            bits ^= low
+        return result
+
+
+class Analysis:
+    """ Base class for a dataflow analysis. Subclasses provide:
+    forward: True for a forward analysis, False for backward
+    boundary(): the fact entering the entry block (forward) or leaving the
+                exit blocks (backward)
+    top(): the initial fact for every other block
+    meet(facts): combine a non-empty list of facts
+    transfer(b, fact): the fact after (forward) / before (backward) block b,
+                       given the fact before / after it. Must not modify
+                       `fact`.
+    """
+    forward = True
+
+    def boundary(self):
+        return self.top()
+
+
+class BitVectorAnalysis(Analysis):
+    """ A gen/kill analysis with facts held as int bit vectors.
+    gen, kill: block idx -> bit vector
+    may: True if facts meet with union, False for intersection
+    universe: bit vector of every element (the top value of a must analysis)
+    """
+    def __init__(self, gen, kill, may=True, universe=0, boundary=0):
+        self.gen = gen
+        self.kill = kill
+        self.may = may
+        self.universe = universe
+        self._boundary = boundary
+
+    def boundary(self):
+        return self._boundary
+
+    def top(self):
+        return 0 if self.may else self.universe
+
+    def meet(self, facts):
+        result = facts[0]
+        if self.may:
+            for f in facts[1:]:
+                result |= f
+        else:
+            for f in facts[1:]:
+                result &= f
+        return result
+
+    def transfer(self, b, fact):
+        return self.gen[b] | (fact & ~self.kill[b])
+
+
+# Solve `analysis` over graph (a brilpy.CFG). Returns (in_b, out_b): the facts
+# at the start and end of each block, respectively. `iterations` (the number of
+# blocks processed) is recorded on the analysis object, and in stats.
+def solve(graph, analysis):
+    name = 'dataflow.' + type(analysis).__name__
+    with stats.timer(name):
+        result = _solve(graph, analysis)
+    stats.add(name + '.iterations', analysis.iterations)
+    return result
+
+def _solve(graph, analysis):
+    n = graph.n
+
+    if analysis.forward:
+        order = graph.rpo()
+        preds = graph.preds
+        succs = graph.edges
+        sources = [0]
+    else:
+        order = list(reversed(graph.rpo()))
+        preds = graph.edges
+        succs = graph.preds
+        sources = [b for b in range(n) if not graph.edges[b]]
+
+    is_source = [False] * n
+    for b in sources:
+        is_source[b] = True
+
+    # before[b]/after[b] are the facts flowing into/out of b in the direction
+    # of the analysis
+    before = [analysis.top() for i in range(n)]
+    after = [analysis.top() for i in range(n)]
+
+    prio = [0] * n
+    for i,b in enumerate(order):
+        prio[b] = i
+
+    worklist = [(prio[b], b) for b in range(n)]
+    heapq.heapify(worklist)
+    queued = [True] * n
+
+    iterations = 0
+    while worklist:
+        (_, b) = heapq.heappop(worklist)
+        queued[b] = False
+        iterations += 1
+
+        facts = [after[p] for p in preds[b]]
+        if is_source[b]:
+            facts.append(analysis.boundary())
+        before[b] = analysis.meet(facts) if facts else analysis.top()
+
+        new = analysis.transfer(b, before[b])
+        if new != after[b]:
+            after[b] = new
+            for s in succs[b]:
+                if not queued[s]:
+                    queued[s] = True
+                    heapq.heappush(worklist, (prio[s], s))
+
+    analysis.iterations = iterations
+
+    if analysis.forward:
+        return (before, after)
+    else:
+        return (after, before)
+
+# ------------------------------------------------------------------------------
+# Defined variables: the set of variables that may have been assigned along some
+# path to each point.
+# ------------------------------------------------------------------------------
+
+class DefinedVars(BitVectorAnalysis):
+    """ vars: Numbering of variable names """
+    def __init__(self, func, graph):
+        self.vars = Numbering([a['name'] for a in func.get('args', [])])
+        entry = self.vars.bits([a['name'] for a in func.get('args', [])])
+
+        gen = []
+        for block in graph.blocks:
+            gen.append(self.vars.bits([inst['dest'] for inst in block if 'dest' in inst]))
+
+        super().__init__(gen, [0] * graph.n, boundary=entry)
+
+# ------------------------------------------------------------------------------
+# Live variables: the set of variables that may be read, along some path from
+# each point, before being assigned. The args of a phi are read at the end of
+# the predecessor they come from, not in the phi's own block.
+# ------------------------------------------------------------------------------
+
+# The args of inst that are variables (the second arg of getmbr is a field)
+def var_args(inst):
+    if 'args' not in inst:
+        return []
+    if inst.get('op') == 'getmbr':
+        return inst['args'][:1]
+    return inst['args']
+
+class LiveVars(BitVectorAnalysis):
+    """ vars: Numbering of variable names
+    phi_uses: block idx -> bit vector of the vars that phis in its successors
+              read on the edges from it
+    """
+    forward = False
+
+    def __init__(self, func, graph):
+        self.vars = Numbering()
+        self.phi_uses = [0] * graph.n
+
+        block_by_label = {}
+        for i,name in enumerate(graph.names):
+            block_by_label[name] = i
+
+        gen = []
+        kill = []
+        for block in graph.blocks:
+            g = 0
+            k = 0
+            for inst in block:
+                if inst.get('op') == 'phi':
+                    for (a, lbl) in zip(inst['args'], inst['labels']):
+                        if lbl in block_by_label:
+                            self.phi_uses[block_by_label[lbl]] |= 1 << self.vars.id(a)
+                else:
+                    for a in var_args(inst):
+                        bit = 1 << self.vars.id(a)
+                        if not k & bit:
+                            g |= bit
+                if 'dest' in inst:
+                    k |= 1 << self.vars.id(inst['dest'])
+            gen.append(g)
+            kill.append(k)
+
+        super().__init__(gen, kill)
+
+    def transfer(self, b, fact):
+        return self.gen[b] | ((fact | self.phi_uses[b]) & ~self.kill[b])
+
+    # Solve. Returns (live_in, live_out) bit vectors for each block, where
+    # live_out includes the vars read by successors' phis.
+    def run(self, graph):
+        (in_b, out_b) = solve(graph, self)
+        return (in_b, [x | self.phi_uses[b] for b,x in enumerate(out_b)])
+
+# ------------------------------------------------------------------------------
+# Reaching definitions. A definition is a (variable, block idx) pair, i.e., we
+# record which block a reaching definition is in, not which instruction. Under
+# SSA there is only one definition of each variable, so the facts can be read
+# as maps from variable name -> defining block (see RDView).
+# ------------------------------------------------------------------------------
+
+class ReachingDefs(BitVectorAnalysis):
+    """ defs: Numbering of (var, block idx) definitions (args are defined in
+              block 0)
+    var_defs: var -> bit vector of all of its definitions
+    """
+    def __init__(self, func, graph):
+        self.defs = Numbering()
+        self.var_defs = {}
+
+        def define(var, b):
+            bit = 1 << self.defs.id((var, b))
+            self.var_defs[var] = self.var_defs.get(var, 0) | bit
+            return bit
+
+        entry = 0
+        for arg in func.get('args', []):
+            entry |= define(arg['name'], 0)
+
+        gen = []
+        block_vars = []
+        for b,block in enumerate(graph.blocks):
+            g = 0
+            dests = set()
+            for inst in block:
+                if 'dest' in inst:
+                    g |= define(inst['dest'], b)
+                    dests.add(inst['dest'])
+            gen.append(g)
+            block_vars.append(dests)
+
+        # A definition in a block kills every other definition of its variable
+        kill = []
+        for b,dests in enumerate(block_vars):
+            k = 0
+            for v in dests:
+                k |= self.var_defs[v]
+            kill.append(k & ~gen[b])
+
+        for v,bits in self.var_defs.items():
+            if bits & (bits - 1):
+                print("warning: illegal redef of var `{}` (multiple blocks).".format(v) +
+                      " This function assumes SSA.", file=sys.stderr)
+
+        super().__init__(gen, kill, boundary=entry)
+
+    # Solve, and wrap the resulting facts as var -> block maps
+    def run(self, graph):
+        (in_b, out_b) = solve(graph, self)
+        return ([RDView(self, x) for x in in_b], [RDView(self, x) for x in out_b])
+
+
+class RDView:
+    """ Read-only var -> defining block map over one ReachingDefs fact. If
+    several definitions of a variable reach (i.e., not SSA), the one in the
+    highest numbered block wins.
+    """
+    def __init__(self, rd, bits):
+        self.rd = rd
+        self.bits = bits
+
+    def _block(self, var):
+        reaching = self.bits & self.rd.var_defs.get(var, 0)
+        if not reaching:
+            return None
+        return max(b for (v, b) in self.rd.defs.members(reaching))
+
+    def __getitem__(self, var):
+        b = self._block(var)
+        if b is None:
+            raise KeyError(var)
+        return b
+
+    def __contains__(self, var):
+        return self._block(var) is not None
+
+    def get(self, var, default=None):
+        b = self._block(var)
+        return default if b is None else b
+
+    def keys(self):
+        return set(v for (v, b) in self.rd.defs.members(self.bits))
+
+    def items(self):
+        return [(v, self[v]) for v in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
@@ -3,86 +3,151 @@
 import sys
 import json
 from brilpy import *
-from functools import reduce
+import stats
 
 class Dominators:
-
-    def __init__(self, func):
-        g = CFG(func)
-
-        # First compute dominators
-        # IMPORTANT: This computes, for each block, the set of blocks that dominate
-        # it, not the other way around
-        self.doms = []
-        self.doms.append(set([0])) # Entry block is special, it's its own dominator
-        for i in range(1,g.n):
-            self.doms.append(set(range(g.n)))
-
-        order = g.rpo()
-
+    """ Dominator information for a function's CFG.
+    idom: block idx -> idx of its immediate dominator (None for the entry
+          block and for blocks unreachable from it)
+    dom_tree: idx -> list of children in the dominator tree. The entry block is
+              the (only) child of None. Blocks without children are omitted.
+    frontier: idx -> set of blocks in its dominance frontier
+    doms, dom_by: for each block, the set of blocks that dominate it / that it
+                  dominates. These take O(n^2) space, so they are only built if
+                  asked for; prefer dominates().
+    """
+
+    # g: the CFG of func, if already computed
+    def __init__(self, func, g=None):
+        if g is None:
+            g = CFG(func)
+
+        with stats.timer('dominators'):
+            self._compute(g)
+
+    def _compute(self, g):
+        self.n = g.n
+
+        # Immediate dominators, following Cooper, Harvey and Kennedy, "A Simple,
+        # Fast Dominance Algorithm". Blocks are visited in reverse postorder,
+        # and rpo_num is each block's position in that order (None if
+        # unreachable from the entry).
+        order = g.rpo([0])
+        rpo_num = [None] * g.n
+        for i,b in enumerate(order):
+            rpo_num[b] = i
+
+        # Walk up from a and b to their nearest common dominator
+        def intersect(a, b):
+            while a != b:
+                while rpo_num[a] > rpo_num[b]:
+                    a = idom[a]
+                while rpo_num[b] > rpo_num[a]:
+                    b = idom[b]
+            return a
+
+        idom = [None] * g.n
+        idom[0] = 0
         changed = True
+        rounds = 0
         while changed:
             changed = False
-            for i in order[1:]: # no one can dominate 0 except 0
-                d = {i}
-                if g.preds[i]:
-                    d |= reduce(set.intersection, [self.doms[p] for p in g.preds[i]], set(range(g.n)))
-
-                if d != self.doms[i]:
+            rounds += 1
+            for b in order[1:]: # no one can dominate 0 except 0
+                new_idom = None
+                for p in g.preds[b]:
+                    if idom[p] is not None:
+                        new_idom = p if new_idom is None else intersect(p, new_idom)
+
+                if new_idom != idom[b]:
+                    idom[b] = new_idom
                     changed = True
-                    self.doms[i] = d
-
-        # Compute the "other way around" (from above), that is, for each block, the
-        # set of blocks this block dominates
-        self.dom_by = []
-        for i in range(g.n):
-            self.dom_by.append(set())
-
-        for i,d in enumerate(self.doms):
-            for mbr in d:
-                self.dom_by[mbr].add(i)
-
 
+        idom[0] = None
+        self.idom = idom
+        stats.add('dominators.rounds', rounds)
 
         # Compute the dominance tree
-        dt_parent = [None]
-
+        self.dom_tree = {None: [0]}
         for i in range(1, g.n):
-            for j in self.doms[i]:
-                if i != j:  # j strictly dominates i
-                    immed_dom = True
-                    for k in range(g.n):
-                        if k != j and k != i and j in self.doms[k] and k in self.doms[i]:
-                            immed_dom = False
-                            break
-                    if immed_dom:
-                        dt_parent.append(j)
-                        break
-
-        self.dom_tree = {}
-        for i,p in enumerate(dt_parent):
-            if p in self.dom_tree:
-                self.dom_tree[p].append(i)
+            if idom[i] is not None:
+                if idom[i] in self.dom_tree:
+                    self.dom_tree[idom[i]].append(i)
+                else:
+                    self.dom_tree[idom[i]] = [i]
+
+        # Number the dominance tree in pre- and postorder, so that a dominates
+        # b iff b's interval nests inside a's
+        self.pre = [None] * g.n
+        self.post = [None] * g.n
+        counter = 0
+        stack = [(0, 0)]
+        self.pre[0] = counter
+        while stack:
+            (u, k) = stack[-1]
+            children = self.dom_tree.get(u, [])
+            if k < len(children):
+                stack[-1] = (u, k + 1)
+                counter += 1
+                self.pre[children[k]] = counter
+                stack.append((children[k], 0))
             else:
-                self.dom_tree[p] = [i]
+                stack.pop()
+                counter += 1
+                self.post[u] = counter
 
-        # Compute dominance frontier
+        # Compute dominance frontier: walk up from each (reachable) pred of a
+        # block until reaching the block's immediate dominator; every block
+        # passed on the way has it in its frontier.
         self.frontier = []
         for i in range(g.n):
             self.frontier.append(set())
 
-        for i,d in enumerate(self.doms):
-            # Union of dominators for this node's preds
-            pre_doms = reduce(set.union, [self.doms[p] for p in g.preds[i]], set())
-            # Subtract out strict dominators for this node
-            pre_doms = pre_doms.difference(self.doms[i].difference(set([i])))
-
-            # This node is in the frontier for the remaining nodes:
-            for p in pre_doms:
-                self.frontier[p].add(i)
-
-
-
+        for i in order:
+            for p in g.preds[i]:
+                if rpo_num[p] is None:
+                    continue
+                runner = p
+                while runner is not None and runner != idom[i]:
+                    self.frontier[runner].add(i)
+                    runner = idom[runner]
+
+        self._doms = None
+        self._dom_by = None
+
+    # True iff block a dominates block b (every block dominates itself)
+    def dominates(self, a, b):
+        if a == b:
+            return True
+        if self.pre[a] is None or self.pre[b] is None:
+            return False
+        return self.pre[a] <= self.pre[b] and self.post[b] <= self.post[a]
+
+    # True iff block a dominates block b and a != b
+    def strictly_dominates(self, a, b):
+        return a != b and self.dominates(a, b)
+
+    # List of the blocks dominating b, from b up to the entry
+    def dominators_of(self, b):
+        result = [b]
+        while self.idom[result[-1]] is not None:
+            result.append(self.idom[result[-1]])
+        return result
+
+    @property
+    def doms(self):
+        if self._doms is None:
+            self._doms = [set(self.dominators_of(i)) for i in range(self.n)]
+        return self._doms
+
+    @property
+    def dom_by(self):
+        if self._dom_by is None:
+            self._dom_by = [set() for i in range(self.n)]
+            for i,d in enumerate(self.doms):
+                for mbr in d:
+                    self._dom_by[mbr].add(i)
+        return self._dom_by
 
 
 def main():
@@ -103,10 +168,10 @@ def main():
         print("  edges: {}".format(g.edges))
         print("  preds: {}".format(g.preds))
 
-        d = dominators(func)
+        d = Dominators(func, g)
 
         print("\n\n  doms:\n{}\n".format(d.doms))
-        for k,v in enumerate(doms):
+        for k,v in enumerate(d.doms):
             print("    {}: ".format(g.names[k]), end="")
             for mbr in v:
                 print("{} ".format(g.names[mbr]), end="")
@@ -119,6 +184,8 @@ def main():
         print("digraph g {")
         f.write("digraph g {\n")
         for k,v in d.dom_tree.items():
+            if k is None:
+                continue
             for mbr in v:
                 print("{} -> {};".format(g.names[k], g.names[mbr]))
                 f.write("{} -> {};\n".format(g.names[k], g.names[mbr]))
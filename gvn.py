@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# Global value numbering for programs in SSA form, following the
+# dominator-tree walk ("DVNT") of Briggs, Cooper and Simpson, "Value
+# Numbering".
+#
+# Each SSA name is mapped to the name holding its value. Walking the dominator
+# tree with a scoped hash table from expressions to names, an instruction whose
+# expression was already computed in a dominating block is deleted and its
+# name mapped to the earlier one. `id`s are deleted as well (so chains of them
+# fold to their source), as are phis whose args all have the same value or
+# that compute the same thing as an earlier phi in the block.
+
+import sys
+from brilpy import *
+from analysis import FunctionAnalyses
+from jsonstream import map_functions
+import brilbin
+
+COMMUTE = 'add', 'mul', 'eq', 'and', 'or'
+
+# Ops with no side effects whose result depends only on their args, so that two
+# with the same args compute the same value
+PURE = 'const', 'add', 'mul', 'sub', 'div', 'eq', 'lt', 'gt', 'le', 'ge', \
+       'not', 'and', 'or', 'ptradd', 'getmbr', 'isnull'
+
+# Hashable form of a bril type (pointer types are dicts)
+def type_key(t):
+    if isinstance(t, dict):
+        return ('ptr', type_key(t['ptr']))
+    return t
+
+# Return the hash key for a pure instruction, whose args are already replaced
+# with their value numbers.
+def expr_key(inst):
+    if inst['op'] == 'const':
+        return ('const', type_key(inst['type']), inst['value'])
+
+    args = inst['args']
+    if inst['op'] in COMMUTE:
+        args = sorted(args)
+    return (inst['op'], type_key(inst.get('type')), tuple(args))
+
+def gvn_func(func, fa):
+
+    dests = set()
+    for inst in func['instrs']:
+        if 'dest' in inst:
+            if inst['dest'] in dests:
+                print("warning: `{}` is assigned more than once in function `{}`; "
+                      "skipping GVN (this pass assumes SSA).".format(inst['dest'],
+                      func['name']), file=sys.stderr)
+                return
+            dests.add(inst['dest'])
+
+    g = fa.cfg()
+    domins = fa.dominators()
+
+    # SSA name -> name of its value number
+    vn = {}
+    for arg in func.get('args', []):
+        vn[arg['name']] = arg['name']
+
+    def lookup(name):
+        return vn.get(name, name)
+
+    # expression key -> name; scoped to the current path in the dominator tree
+    table = {}
+
+    # names of the instructions we'd like to delete, and those of them that turn
+    # out to be needed anyway (see phi_arg)
+    removed = set()
+    needed = set()
+
+    # phi dests of each block
+    phi_dests = []
+    for block in g.blocks:
+        phi_dests.append(set([inst['dest'] for inst in block
+                              if 'op' in inst and inst['op'] == 'phi']))
+
+    # The value to use for arg `a` of a phi (with dest `dest`) in block s. Bril
+    # phis take effect one at a time, so a phi must not be made to read another
+    # phi in its own block (it would see the new value, not the old one); in
+    # that case `a` stays, and so must its definition.
+    def phi_arg(a, dest, s):
+        v = lookup(a)
+        if v != dest and v in phi_dests[s]:
+            if a != v:
+                needed.add(a)
+            return a
+        return v
+
+    # Explicit stack for the dominator tree walk: (block, keys added to table
+    # by the block, or None if the block hasn't been visited yet)
+    stack = [(0, None)]
+    while stack:
+        (b, added) = stack.pop()
+
+        if added is not None:
+            for key in added:
+                del table[key]
+            continue
+
+        added = []
+        phi_table = {}
+
+        for inst in g.blocks[b]:
+            if 'op' not in inst:
+                continue
+
+            op = inst['op']
+
+            if op == 'phi':
+                args = [phi_arg(a, inst['dest'], b) for a in inst['args']]
+                inst['args'] = args
+
+                # all the same value: the phi is just a copy
+                if len(set(args)) == 1:
+                    vn[inst['dest']] = args[0]
+                    removed.add(inst['dest'])
+                    continue
+
+                key = tuple(sorted(zip(inst['labels'], args)))
+                if key in phi_table:
+                    vn[inst['dest']] = phi_table[key]
+                    removed.add(inst['dest'])
+                    continue
+
+                phi_table[key] = inst['dest']
+                vn[inst['dest']] = inst['dest']
+                continue
+
+            if 'args' in inst:
+                if op == 'getmbr':
+                    inst['args'] = [lookup(inst['args'][0])] + inst['args'][1:]
+                else:
+                    inst['args'] = [lookup(a) for a in inst['args']]
+
+            if 'dest' in inst:
+                if op == 'id':
+                    vn[inst['dest']] = inst['args'][0]
+                    removed.add(inst['dest'])
+                    continue
+
+                if op in PURE:
+                    key = expr_key(inst)
+                    if key in table:
+                        vn[inst['dest']] = table[key]
+                        removed.add(inst['dest'])
+                        continue
+                    table[key] = inst['dest']
+                    added.append(key)
+
+                vn[inst['dest']] = inst['dest']
+
+        # Update the args of phis in successors that come from this block
+        for s in g.edges[b]:
+            for inst in g.blocks[s]:
+                if 'op' in inst and inst['op'] == 'phi':
+                    inst['args'] = [phi_arg(a, inst['dest'], s) if lbl == g.names[b] else a
+                                    for (a, lbl) in zip(inst['args'], inst['labels'])]
+
+        # Come back to pop this block's table entries after its subtree
+        stack.append((b, added))
+        for c in reversed(domins.dom_tree.get(b, [])):
+            stack.append((c, None))
+
+    newinstrs = []
+    for block in g.blocks:
+        block[:] = [inst for inst in block if 'dest' not in inst
+                    or inst['dest'] not in removed or inst['dest'] in needed]
+        newinstrs += block
+    func['instrs'] = newinstrs
+
+    # Instructions were only removed or renamed inside their blocks, so the CFG
+    # and dominators still hold
+    fa.invalidate('reaching_defs')
+
+# am: an analysis.AnalysisManager to share analyses with other passes, if any
+def gvn(prog, am=None):
+    for func in prog['functions']:
+        if func['instrs']:
+            gvn_func(func, am.function(func) if am else FunctionAnalyses(func))
+    return prog
+
+def main():
+    brilbin.flag(sys.argv)
+    map_functions(gvn)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,549 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# A bril interpreter, with dynamic instruction profiling built in, so programs
+# can be run (and measured) in-process instead of with the external `brili`.
+#
+# usage: interp.py [-p] [--profile FILE] [ARGS ...]  < prog.json
+#
+# -p prints `total_dyn_inst: N` on stderr, like `brili -p` (so brench's
+# `extract` works unchanged), and --profile writes the execution counts of
+# every block and CFG edge to FILE as JSON (see Program.profile). The program
+# may be JSON or binary (see brilbin.py).
+#
+# Supports the core ops and the memory and struct ops that brilc handles.
+# Before anything runs, each function is decoded once into basic blocks (split
+# as brilpy.form_blocks does, so blocks have the same names as in brilpy.CFG).
+# Variables become slots in a list rather than names in a dict, labels become
+# block indices, and each instruction becomes a closure made by the handler
+# for its op, with its slots already bound. Profiling costs one increment per
+# block executed (plus one per `br` taken); instruction and edge counts are
+# worked out from those afterwards.
+
+import json
+import sys
+from brilpy import form_blocks
+from brilbin import read_program
+
+INT_MIN = -2**63
+INT_MAX = 2**63 - 1
+
+# Wrap an int to 64-bit two's complement, like brili does
+def wrap(x):
+    return (x + 2**63) % 2**64 - 2**63
+
+class BrilError(Exception):
+    """ An error in the program being run (not in the interpreter). """
+    pass
+
+class Pointer:
+    """ A pointer to element `off` of `mem`, a list holding an allocation (or,
+    for a pointer made by getmbr, the members of a struct). mem is None for
+    the null pointer.
+    """
+    __slots__ = ('mem', 'off')
+    def __init__(self, mem, off):
+        self.mem = mem
+        self.off = off
+
+NULL = Pointer(None, 0)
+
+def format_value(v):
+    if v is True:
+        return 'true'
+    if v is False:
+        return 'false'
+    if isinstance(v, Pointer):
+        return 'null' if v.mem is None else '<ptr>'
+    return str(v)
+
+# Block kinds: how a block ends
+FALL, JMP, BR, RET = range(4)
+
+
+# ------------------------------------------------------------------------------
+# Instruction handlers: op -> function(inst, d, a, prog) returning the closure
+# that runs inst on a frame (list of slots). d is the slot of inst's dest,
+# a the slots of its args.
+# ------------------------------------------------------------------------------
+
+def make_const(inst, d, a, prog):
+    v = inst['value']
+    if isinstance(inst['type'], dict):
+        v = NULL # the only pointer constant
+    elif inst['type'] == 'bool':
+        v = bool(v)
+    def const(env):
+        env[d] = v
+    return const
+
+def make_id(inst, d, a, prog):
+    (x,) = a
+    def id_(env):
+        env[d] = env[x]
+    return id_
+
+def make_add(inst, d, a, prog):
+    (x, y) = a
+    def add(env):
+        v = env[x] + env[y]
+        env[d] = v if INT_MIN <= v <= INT_MAX else wrap(v)
+    return add
+
+def make_sub(inst, d, a, prog):
+    (x, y) = a
+    def sub(env):
+        v = env[x] - env[y]
+        env[d] = v if INT_MIN <= v <= INT_MAX else wrap(v)
+    return sub
+
+def make_mul(inst, d, a, prog):
+    (x, y) = a
+    def mul(env):
+        v = env[x] * env[y]
+        env[d] = v if INT_MIN <= v <= INT_MAX else wrap(v)
+    return mul
+
+def make_div(inst, d, a, prog):
+    (x, y) = a
+    def div(env):
+        n = env[x]
+        m = env[y]
+        if m == 0:
+            raise BrilError('division by zero')
+        q = abs(n) // abs(m)
+        env[d] = wrap(q if (n < 0) == (m < 0) else -q)
+    return div
+
+def make_eq(inst, d, a, prog):
+    (x, y) = a
+    def eq(env):
+        env[d] = env[x] == env[y]
+    return eq
+
+def make_lt(inst, d, a, prog):
+    (x, y) = a
+    def lt(env):
+        env[d] = env[x] < env[y]
+    return lt
+
+def make_gt(inst, d, a, prog):
+    (x, y) = a
+    def gt(env):
+        env[d] = env[x] > env[y]
+    return gt
+
+def make_le(inst, d, a, prog):
+    (x, y) = a
+    def le(env):
+        env[d] = env[x] <= env[y]
+    return le
+
+def make_ge(inst, d, a, prog):
+    (x, y) = a
+    def ge(env):
+        env[d] = env[x] >= env[y]
+    return ge
+
+def make_not(inst, d, a, prog):
+    (x,) = a
+    def not_(env):
+        env[d] = not env[x]
+    return not_
+
+def make_and(inst, d, a, prog):
+    (x, y) = a
+    def and_(env):
+        env[d] = env[x] and env[y]
+    return and_
+
+def make_or(inst, d, a, prog):
+    (x, y) = a
+    def or_(env):
+        env[d] = env[x] or env[y]
+    return or_
+
+def make_print(inst, d, a, prog):
+    w = prog.out.write
+    def print_(env):
+        w(' '.join([format_value(env[x]) for x in a]) + '\n')
+    return print_
+
+def make_nop(inst, d, a, prog):
+    def nop(env):
+        pass
+    return nop
+
+def make_call(inst, d, a, prog):
+    name = inst['funcs'][0]
+    funcs = prog.funcs
+    if d is None:
+        def call(env):
+            funcs[name].call([env[x] for x in a])
+    else:
+        def call(env):
+            env[d] = funcs[name].call([env[x] for x in a])
+    return call
+
+# A fresh (uninitialized) value of type t: None, or for a struct, a list of
+# its members
+def blank(t, structs):
+    if isinstance(t, str) and t in structs:
+        return [blank(m['type'], structs) for m in structs[t]]
+    return None
+
+def make_alloc(inst, d, a, prog):
+    (x,) = a
+    t = inst['type']['ptr']
+    structs = prog.structs
+    heap = prog.heap
+    def alloc(env):
+        n = env[x]
+        if n <= 0:
+            raise BrilError('cannot allocate {} entries'.format(n))
+        if t in structs:
+            mem = [blank(t, structs) for i in range(n)]
+        else:
+            mem = [None] * n
+        heap[id(mem)] = mem
+        env[d] = Pointer(mem, 0)
+    return alloc
+
+def make_free(inst, d, a, prog):
+    (x,) = a
+    heap = prog.heap
+    def free(env):
+        p = env[x]
+        if p.off != 0 or heap.pop(id(p.mem), None) is None:
+            raise BrilError('freeing a pointer that was not allocated (or already freed)')
+    return free
+
+def check_ptr(p):
+    if p.mem is None:
+        raise BrilError('null pointer dereference')
+    if not 0 <= p.off < len(p.mem):
+        raise BrilError('pointer out of bounds')
+
+def make_load(inst, d, a, prog):
+    (x,) = a
+    def load(env):
+        p = env[x]
+        check_ptr(p)
+        v = p.mem[p.off]
+        if v is None:
+            raise BrilError('load of uninitialized memory')
+        env[d] = v
+    return load
+
+def make_store(inst, d, a, prog):
+    (x, y) = a
+    def store(env):
+        p = env[x]
+        check_ptr(p)
+        p.mem[p.off] = env[y]
+    return store
+
+def make_ptradd(inst, d, a, prog):
+    (x, y) = a
+    def ptradd(env):
+        p = env[x]
+        env[d] = Pointer(p.mem, p.off + env[y])
+    return ptradd
+
+# (a is the slot of the struct pointer, followed by the member's index)
+def make_getmbr(inst, d, a, prog):
+    (x, idx) = a
+    def getmbr(env):
+        p = env[x]
+        check_ptr(p)
+        env[d] = Pointer(p.mem[p.off], idx)
+    return getmbr
+
+def make_isnull(inst, d, a, prog):
+    (x,) = a
+    def isnull(env):
+        env[d] = env[x].mem is None
+    return isnull
+
+HANDLERS = {
+    'const': make_const, 'id': make_id, 'add': make_add, 'sub': make_sub,
+    'mul': make_mul, 'div': make_div, 'eq': make_eq, 'lt': make_lt,
+    'gt': make_gt, 'le': make_le, 'ge': make_ge, 'not': make_not,
+    'and': make_and, 'or': make_or, 'print': make_print, 'nop': make_nop,
+    'call': make_call, 'alloc': make_alloc, 'free': make_free,
+    'load': make_load, 'store': make_store, 'ptradd': make_ptradd,
+    'getmbr': make_getmbr, 'isnull': make_isnull,
+}
+
+
+class Func:
+    """ A decoded function.
+    names: the names of its blocks (as in brilpy.CFG)
+    blocks: list of (phis, body, kind, x, y) for each block, where
+        phis: pred block idx (None for any other) -> list of (dest slot, arg
+              slot or None) for the block's phis when it's entered from that
+              pred
+        body: the closures for the rest of the block's instructions, other
+              than its terminator
+        kind: FALL, JMP (to block x), BR (on slot x, to blocks y) or RET (slot x,
+              or None)
+    sizes: the number of instructions in each block
+    counts, taken: the number of times each block has run, and (for a block
+        ending in a br) taken its first label
+    """
+    def __init__(self, func, prog):
+        self.name = func['name']
+        self.slots = {}
+        self.args = [self.slot(a['name']) for a in func.get('args', [])]
+        self.arg_types = [a['type'] for a in func.get('args', [])]
+        self.calls = 0
+
+        # var -> type, for the struct pointers getmbr needs to know the type of
+        types = {}
+        for a in func.get('args', []):
+            types[a['name']] = a['type']
+        for inst in func['instrs']:
+            if 'dest' in inst and 'type' in inst:
+                types[inst['dest']] = inst['type']
+        phis = [inst for inst in func['instrs']
+                if 'dest' in inst and inst['dest'] not in types]
+        changed = True
+        while changed:
+            changed = False
+            for inst in phis:
+                if inst['dest'] not in types:
+                    for v in inst['args']:
+                        if v in types:
+                            types[inst['dest']] = types[v]
+                            changed = True
+                            break
+
+        blocks = list(form_blocks(func['instrs']))
+        self.names = []
+        index = {}
+        for i,block in enumerate(blocks):
+            name = block[0]['label'] if 'label' in block[0] else 'b' + str(i)
+            self.names.append(name)
+            if 'label' in block[0]:
+                index[name] = i
+
+        def target(label):
+            if label not in index:
+                raise BrilError('unknown label `{}` in function `{}`'.format(label,
+                                self.name))
+            return index[label]
+
+        self.blocks = []
+        self.sizes = []
+        for i,block in enumerate(blocks):
+            instrs = [inst for inst in block if 'op' in inst]
+            self.sizes.append(len(instrs))
+
+            # Each phi takes its arg for the pred we came from, or is undefined
+            # if it has none (phis[None] is for all other ways in)
+            phis = {}
+            phi_insts = [inst for inst in instrs if inst['op'] == 'phi']
+            if phi_insts:
+                preds = set([index[l] for inst in phi_insts for l in inst['labels']
+                             if l in index])
+                for p in list(preds) + [None]:
+                    phis[p] = []
+                for inst in phi_insts:
+                    d = self.slot(inst['dest'])
+                    arg = {}
+                    for (v, l) in zip(inst['args'], inst['labels']):
+                        if l in index:
+                            arg[index[l]] = self.slot(v)
+                    for p in phis:
+                        phis[p].append((d, arg.get(p)))
+
+            body = []
+            kind = FALL
+            x = y = None
+            for inst in instrs:
+                op = inst['op']
+                if op == 'phi':
+                    continue
+                if op == 'getmbr':
+                    a = [self.slot(inst['args'][0])]
+                else:
+                    a = [self.slot(v) for v in inst.get('args', [])]
+                if op == 'jmp':
+                    (kind, x) = (JMP, target(inst['labels'][0]))
+                elif op == 'br':
+                    (kind, x) = (BR, a[0])
+                    y = (target(inst['labels'][0]), target(inst['labels'][1]))
+                elif op == 'ret':
+                    (kind, x) = (RET, a[0] if a else None)
+                elif op in HANDLERS:
+                    if op == 'getmbr':
+                        struct = types[inst['args'][0]]['ptr']
+                        a.append(prog.member_index(struct, inst['args'][1]))
+                    d = self.slot(inst['dest']) if 'dest' in inst else None
+                    body.append(HANDLERS[op](inst, d, a, prog))
+                else:
+                    raise BrilError('unknown op `{}`'.format(op))
+
+            self.blocks.append((phis, body, kind, x, y))
+
+        self.nslots = len(self.slots)
+        self.counts = [0] * len(self.blocks)
+        self.taken = [0] * len(self.blocks)
+
+    def slot(self, var):
+        s = self.slots.get(var)
+        if s is None:
+            s = len(self.slots)
+            self.slots[var] = s
+        return s
+
+    # Run the function on the list of arg values, returning its result (or None)
+    def call(self, argv):
+        self.calls += 1
+        env = [None] * self.nslots
+        for (s, v) in zip(self.args, argv):
+            env[s] = v
+
+        blocks = self.blocks
+        counts = self.counts
+        n = len(blocks)
+        b = 0
+        prev = None
+        while b < n:
+            (phis, body, kind, x, y) = blocks[b]
+            counts[b] += 1
+
+            if phis:
+                for (d, s) in phis.get(prev, phis[None]):
+                    env[d] = None if s is None else env[s]
+
+            for f in body:
+                f(env)
+
+            prev = b
+            if kind == FALL:
+                b += 1
+            elif kind == JMP:
+                b = x
+            elif kind == BR:
+                if env[x]:
+                    self.taken[b] += 1
+                    b = y[0]
+                else:
+                    b = y[1]
+            else:
+                return None if x is None else env[x]
+        return None
+
+    # The number of instructions run
+    def dyn_insts(self):
+        return sum([c * s for (c, s) in zip(self.counts, self.sizes)])
+
+    # Block name -> times run, and a list of (from, to, times taken) for each
+    # CFG edge
+    def profile(self):
+        blocks = {}
+        edges = []
+        for b,(phis, body, kind, x, y) in enumerate(self.blocks):
+            c = self.counts[b]
+            blocks[self.names[b]] = c
+            if kind == FALL and b + 1 < len(self.blocks):
+                edges.append((b, b + 1, c))
+            elif kind == JMP:
+                edges.append((b, x, c))
+            elif kind == BR:
+                edges.append((b, y[0], self.taken[b]))
+                edges.append((b, y[1], c - self.taken[b]))
+        return {'calls': self.calls, 'blocks': blocks,
+                'edges': [[self.names[p], self.names[s], c] for (p, s, c) in edges]}
+
+
+class Program:
+    """ A decoded bril program, ready to run (any number of times; the profile
+    counts add up across runs).
+    """
+    def __init__(self, prog, out=None):
+        self.out = out if out is not None else sys.stdout
+        self.structs = {}
+        for s in prog.get('structs', []):
+            self.structs[s['name']] = s['mbrs']
+        self.heap = {}
+        self.funcs = {}
+        for func in prog['functions']:
+            self.funcs[func['name']] = Func(func, self)
+
+    # Index of member `name` of struct type t
+    def member_index(self, t, name):
+        for i,m in enumerate(self.structs.get(t, [])):
+            if m['name'] == name:
+                return i
+        raise BrilError('struct `{}` has no member `{}`'.format(t, name))
+
+    # Run main with the args (strings, as on the command line). Raises BrilError
+    # if the program goes wrong.
+    def run(self, args=()):
+        main = self.funcs.get('main')
+        if main is None:
+            raise BrilError('no main function')
+        types = main.arg_types
+        if len(args) != len(types):
+            raise BrilError('main expects {} args, got {}'.format(len(types), len(args)))
+        argv = [a == 'true' if t == 'bool' else int(a) for (a, t) in zip(args, types)]
+
+        try:
+            main.call(argv)
+        except (TypeError, AttributeError, KeyError) as e:
+            raise BrilError('bad operand (undefined variable?): {}'.format(e))
+        except RecursionError:
+            raise BrilError('call stack too deep')
+
+        if self.heap:
+            raise BrilError('some memory locations have not been freed by end of execution')
+
+    def dyn_insts(self):
+        return sum([f.dyn_insts() for f in self.funcs.values()])
+
+    # JSON-able profile: {"total_dyn_inst": N, "functions": {name: {"calls": n,
+    # "blocks": {block: n}, "edges": [[from, to, n], ...]}}}
+    def profile(self):
+        return {'total_dyn_inst': self.dyn_insts(),
+                'functions': {name: f.profile() for (name, f) in self.funcs.items()}}
+
+def main():
+    argv = sys.argv[1:]
+    count = False
+    profile = None
+    args = []
+    while argv:
+        a = argv.pop(0)
+        if a == '-p':
+            count = True
+        elif a == '--profile':
+            profile = argv.pop(0)
+        else:
+            args.append(a)
+
+    sys.setrecursionlimit(100000)
+    try:
+        p = Program(read_program())
+    except BrilError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        sys.exit(2)
+
+    status = 0
+    try:
+        p.run(args)
+    except BrilError as e:
+        sys.stdout.flush()
+        print('error: {}'.format(e), file=sys.stderr)
+        status = 2
+
+    if count:
+        print('total_dyn_inst: {}'.format(p.dyn_insts()), file=sys.stderr)
+    if profile:
+        with open(profile, 'w') as f:
+            json.dump(p.profile(), f)
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# Reading and writing bril programs a function at a time. A tool that treats
+# each function on its own (see map_functions) then holds one function at a
+# time, not the whole program: its memory goes with the size of the largest
+# function rather than of the input, and it starts writing output before it has
+# read all of the input.
+#
+# The text written is the same as json.dump(prog) would write (with
+# "functions" as the first key), but each function is encoded in one go by
+# json.dumps, which is much faster: json.dump goes through the pure-Python
+# encoder.
+#
+# Top-level keys other than "functions" (e.g., "structs") are kept as they're
+# read; a function only sees the ones that come before the function list in
+# the input.
+#
+# Programs in the binary format (brilbin.py) are read and written here too, so
+# tools built on map_functions take either format, and write binary with
+# --bin.
+
+import json
+import sys
+import brilbin
+from cache import from_env
+import stats
+
+# How much to read at a time (at least; see Reader._more)
+CHUNK = 1 << 16
+
+_decoder = json.JSONDecoder()
+_whitespace = json.decoder.WHITESPACE
+
+class Reader:
+    """ A bril program being read from text stream f. functions() yields its
+    functions in order; `other` holds the other top-level keys read so far
+    (all of them, once functions() is done).
+    """
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.other = {}
+
+    # Drop what's been parsed and read more of the input: at least as much as
+    # is left in the buffer, so a value that takes many reads to complete is
+    # only parsed (and found incomplete) O(log n) times. False at the end.
+    def _more(self):
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        chunk = self.f.read(max(CHUNK, len(self.buf)))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    # Skip whitespace, and return the next character ('' at the end)
+    def _peek(self):
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                return ''
+
+    # Consume the next character, which must be one of `chars`, and return it
+    def _expect(self, chars):
+        c = self._peek()
+        if c == '' or c not in chars:
+            raise json.JSONDecodeError("Expecting one of '{}'".format(chars),
+                                       self.buf, self.pos)
+        self.pos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                (value, end) = _decoder.raw_decode(self.buf, self.pos)
+
+                # (a number at the end of the buffer may go on in the next read)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._more()
+
+    def functions(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            if self._peek() != '"':
+                raise json.JSONDecodeError("Expecting property name enclosed in "
+                                           "double quotes", self.buf, self.pos)
+            key = self._value()
+            self._expect(':')
+            if key == 'functions':
+                self._expect('[')
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.other[key] = self._value()
+            if self._expect(',}') == '}':
+                break
+        if self._peek() != '':
+            raise json.JSONDecodeError("Extra data", self.buf, self.pos)
+
+
+class Writer:
+    """ Writes a bril program to text stream f, a function at a time. Call
+    function() for each function, then close() with the other top-level keys.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def function(self, func):
+        self.raw(json.dumps(func))
+
+    # Write a function given as its JSON text
+    def raw(self, text):
+        self.f.write('{"functions": [' if self.count == 0 else ', ')
+        self.f.write(text)
+        self.count += 1
+
+    def close(self, other={}):
+        if self.count == 0:
+            self.f.write('{"functions": [')
+        self.f.write(']')
+        for (key, value) in other.items():
+            self.f.write(', {}: {}'.format(json.dumps(key), json.dumps(value)))
+        self.f.write('}')
+
+
+# Run fn (which takes a program and returns it transformed, treating each
+# function on its own) on the program in fin (default: stdin), one function at
+# a time, writing the result to fout (default: stdout) as it goes. fn is given
+# a program holding just the one function (and the other top-level keys read
+# so far).
+#
+# The input may be JSON or binary (brilbin.py); the output is binary if
+# brilbin.WRITE_BINARY is set. With a cache (see cache.py), a function's
+# result is taken from it if `tool` was run on the function before, without
+# even decoding the function if the input is binary.
+def map_functions(fn, fin=None, fout=None, cache=None, tool=None):
+    fin = sys.stdin if fin is None else fin
+    fout = sys.stdout if fout is None else fout
+
+    if brilbin.is_binary(fin):
+        program = brilbin.load(fin)
+        other = program.other()
+        items = ((program.blob(i), None) for i in range(len(program)))
+    else:
+        reader = Reader(fin)
+        other = reader.other
+        items = ((None, func) for func in reader.functions())
+
+    # (cached results are in the output format)
+    if brilbin.WRITE_BINARY:
+        writer = brilbin.Writer(brilbin.binary_stream(fout))
+        (encode, write) = (brilbin.encode, writer.blob)
+        tool = '{} (binary)'.format(tool)
+    else:
+        writer = Writer(fout)
+        (encode, write) = (json.dumps, writer.raw)
+
+    for (blob, func) in items:
+        if cache:
+            key = cache.key(func if blob is None else blob, tool,
+                            other.get('structs'))
+            out = cache.get(key, binary=brilbin.WRITE_BINARY)
+            if out is not None:
+                write(out)
+                continue
+        if func is None:
+            func = brilbin.decode(blob)
+
+        prog = dict(other)
+        prog['functions'] = [func]
+        for f in fn(prog)['functions']:
+            out = encode(f)
+            write(out)
+            if cache:
+                cache.put(key, out)
+    writer.close(other)
+
+# The main() of a pass that treats each function on its own: run fn on the
+# program on stdin a function at a time (through the cache, as `tool`,
+# unless cached is False), and write the result to stdout. With stats on, it
+# counts as one run of pass `name`.
+def stream_pass(name, fn, tool=None, cached=True):
+    cache = from_env() if cached else None
+    start = len(stats.passes)
+    map_functions(lambda prog: stats.run_pass(name, fn, prog), cache=cache,
+                  tool=name if tool is None else tool)
+    stats.fold(start)
+    if cache:
+        cache.trim()
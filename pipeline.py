@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# Runs a sequence of passes over a bril program in a single process, so the
+# program is parsed and serialized exactly once no matter how many passes run.
+#
+# usage: pipeline.py [-c] [--time] [--stats] [--bin] PASS [PASS ...]  < prog.json > out.json
+#
+# -c holds instructions in the compact form from compactir.py instead of dicts.
+# The program may be JSON or binary (see brilbin.py); --bin writes binary.
+# --time reports the time taken by each pass on stderr; --stats reports much
+# more (see stats.py), as the only thing on stderr.
+#
+# Unless a pass looks at the whole program (WHOLE_PROGRAM), the program is read,
+# run through the passes and written a function at a time (see jsonstream.py).
+# With BRIL_CACHE set (see cache.py), functions the same passes were already
+# run on are then taken from the cache, and the passes only run on the rest.
+
+import importlib
+import os
+import sys
+import time
+from analysis import AnalysisManager
+import brilbin
+from cache import from_env, run_cached
+from jsonstream import map_functions
+import stats
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Pass name -> (directory, module, function). Each function takes the whole
+# program and returns the transformed program.
+PASSES = {
+    'lvn':      ('03', 'lvn', 'lvn'),
+    'dce':      ('03', 'dce', 'dce'),
+    'dce_ssa':  ('03', 'dce', 'dce_ssa'),
+    'to_ssa':   ('.', 'ssa', 'to_ssa'),
+    'to_ssa_semipruned': ('.', 'ssa', 'to_ssa_semipruned'),
+    'to_ssa_minimal': ('.', 'ssa', 'to_ssa_minimal'),
+    'from_ssa': ('.', 'ssa', 'from_ssa'),
+    'from_ssa_naive': ('.', 'ssa', 'from_ssa_naive'),
+    'gvn':      ('.', 'gvn', 'gvn'),
+    'sccp':     ('.', 'sccp', 'sccp'),
+    'licm':     ('07', 'licm', 'licm'),
+    'specop':   ('11', 'specop', 'specop'),
+}
+
+# Passes that take an `am` argument: they use the shared analysis.AnalysisManager
+# and invalidate only what they change. After any other pass, every cached
+# analysis is dropped.
+USES_ANALYSES = {'to_ssa', 'to_ssa_semipruned', 'to_ssa_minimal', 'from_ssa',
+                 'from_ssa_naive', 'gvn', 'sccp', 'licm'}
+
+# Passes that look at more than one function at a time (or at anything besides
+# the program), so their results can't be cached per function
+WHOLE_PROGRAM = {'specop'}
+
+def load_pass(name):
+    (subdir, module, fn) = PASSES[name]
+
+    # Shared modules (brilpy, dom, ssa) should always come from the top level,
+    # so lesson directories go at the end of the path
+    path = os.path.normpath(os.path.join(ROOT, subdir))
+    if path not in sys.path:
+        sys.path.append(path)
+
+    return getattr(importlib.import_module(module), fn)
+
+# Run each of the named passes, in order, on prog. Returns the transformed
+# program and a list of (name, seconds) for each pass.
+def run_passes(prog, names):
+    am = AnalysisManager()
+    times = []
+    for name in names:
+        p = load_pass(name)
+        start = time.perf_counter()
+        if name in USES_ANALYSES:
+            prog = stats.run_pass(name, lambda prog: p(prog, am), prog)
+        else:
+            prog = stats.run_pass(name, p, prog)
+            am.invalidate()
+        times.append((name, time.perf_counter() - start))
+    return (prog, times)
+
+def main():
+    names = brilbin.flag(stats.flag(sys.argv[1:]))
+
+    # -c: hold instructions in the compact form (see compactir.py)
+    compact = bool(names) and names[0] == '-c'
+    if compact:
+        names = names[1:]
+
+    # --time: report the time taken by each pass
+    timing = '--time' in names
+    names = [name for name in names if name != '--time']
+
+    for name in names:
+        if name not in PASSES:
+            print("unknown pass `{}`; expected one of: {}".format(name,
+                  ', '.join(PASSES)), file=sys.stderr)
+            sys.exit(1)
+
+    # Whole-program passes can't be cached, or run a function at a time
+    local = not WHOLE_PROGRAM & set(names)
+    cache = from_env() if local else None
+    if cache:
+        # (the passes must be loaded before the cache key's tool version is
+        # computed)
+        for name in names:
+            load_pass(name)
+
+    # seconds spent in each pass, over every run
+    times = [0.0] * len(names)
+    def run(p):
+        (p, t) = run_passes(p, names)
+        for (i, (name, seconds)) in enumerate(t):
+            times[i] += seconds
+        return p
+
+    if compact:
+        import compactir
+        if brilbin.is_binary(sys.stdin):
+            prog = compactir.from_json(brilbin.read_program())
+        else:
+            prog = compactir.load(sys.stdin)
+        if cache:
+            prog = run_cached(prog, ' '.join(names), run, cache, trim=False)
+        else:
+            prog = run(prog)
+        brilbin.write_program(prog, default=compactir.to_dict)
+    elif local:
+        # One function at a time, so only one is ever held (see jsonstream.py)
+        start = len(stats.passes)
+        map_functions(run, cache=cache, tool=' '.join(names))
+        stats.fold(start, len(names))
+    else:
+        brilbin.write_program(run(brilbin.read_program()))
+
+    if timing:
+        for (name, t) in zip(names, times):
+            print("{}: {:.6f}s".format(name, t), file=sys.stderr)
+    if cache:
+        cache.trim()
+
+if __name__ == '__main__':
+    main()
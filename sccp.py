@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# Sparse conditional constant propagation (Wegman and Zadeck, "Constant
+# Propagation with Conditional Branches") for programs in SSA form.
+#
+# Each SSA name starts out unknown (TOP, i.e., absent from `value`) and can only
+# move down to a constant and then to NAC ("not a constant"). Only CFG edges
+# found to be executable contribute to phis, and a branch on a constant marks
+# only the edge it takes. Afterwards:
+#   - instructions (and phis) whose result is constant become `const`s,
+#   - branches on constants become jumps,
+#   - blocks that can never execute are deleted, along with the phi args
+#     that came from them.
+# The old uses of folded values are left for DCE to clean up.
+
+import sys
+from brilpy import *
+from analysis import FunctionAnalyses
+from jsonstream import map_functions
+import brilbin
+
+NAC = 'nac' # lattice bottom
+
+def wrap(x):
+    """ Wrap an int to 64-bit two's complement, like brili does. """
+    return (x + 2**63) % 2**64 - 2**63
+
+def div(x, y):
+    q = abs(x) // abs(y)
+    return q if (x < 0) == (y < 0) else -q
+
+FOLD = {
+    'add': lambda x, y: wrap(x + y),
+    'mul': lambda x, y: wrap(x * y),
+    'sub': lambda x, y: wrap(x - y),
+    'div': lambda x, y: wrap(div(x, y)),
+    'eq':  lambda x, y: x == y,
+    'lt':  lambda x, y: x < y,
+    'gt':  lambda x, y: x > y,
+    'le':  lambda x, y: x <= y,
+    'ge':  lambda x, y: x >= y,
+    'and': lambda x, y: x and y,
+    'or':  lambda x, y: x or y,
+    'not': lambda x: not x,
+}
+
+# Lattice meet of two known values (neither TOP)
+def meet(a, b):
+    if a == NAC or b == NAC:
+        return NAC
+    if type(a) is type(b) and a == b:
+        return a
+    return NAC
+
+# Compute the value of non-phi instruction inst, given the map of known values.
+# Returns None for TOP.
+def evaluate(inst, value):
+    op = inst['op']
+
+    if op == 'const':
+        if inst['type'] in ('int', 'bool'):
+            return inst['value']
+        return NAC
+
+    if op == 'id':
+        return value.get(inst['args'][0])
+
+    if op not in FOLD:
+        return NAC
+
+    args = [value.get(a) for a in inst['args']]
+    if NAC in args:
+        return NAC
+    if None in args:
+        return None
+    if op == 'div' and args[1] == 0:
+        return NAC # leave it to trap at run time
+    return FOLD[op](*args)
+
+def sccp_func(func, fa):
+
+    dests = set()
+    for inst in func['instrs']:
+        if 'dest' in inst:
+            if inst['dest'] in dests:
+                print("warning: `{}` is assigned more than once in function `{}`; "
+                      "skipping SCCP (this pass assumes SSA).".format(inst['dest'],
+                      func['name']), file=sys.stderr)
+                return
+            dests.add(inst['dest'])
+
+    g = fa.cfg()
+
+    block_by_label = {}
+    for i,name in enumerate(g.names):
+        block_by_label[name] = i
+
+    # var -> list of (block idx, instruction) using it
+    uses = {}
+    for b,block in enumerate(g.blocks):
+        for inst in block:
+            if 'args' in inst:
+                for a in inst['args']:
+                    if a in uses:
+                        uses[a].append((b, inst))
+                    else:
+                        uses[a] = [(b, inst)]
+
+    value = {}
+    for arg in func.get('args', []):
+        value[arg['name']] = NAC
+
+    executable = [False] * g.n
+    exec_edges = set()
+
+    cfg_work = [(None, 0)]
+    ssa_work = []
+
+    def set_value(var, v):
+        if v is not None and value.get(var) != v:
+            value[var] = v
+            ssa_work.extend(uses.get(var, []))
+
+    def visit_phi(b, inst):
+        v = None
+        for (a, lbl) in zip(inst['args'], inst['labels']):
+            if (block_by_label.get(lbl), b) in exec_edges:
+                va = value.get(a)
+                if va is not None:
+                    v = va if v is None else meet(v, va)
+        set_value(inst['dest'], v)
+
+    # Mark the outgoing edges of b that can be taken
+    def visit_term(b):
+        last = g.blocks[b][-1]
+        if 'op' in last and last['op'] == 'br':
+            cond = value.get(last['args'][0])
+            if cond is None:
+                return
+            if cond == NAC:
+                targets = last['labels']
+            else:
+                targets = [last['labels'][0 if cond else 1]]
+            for lbl in targets:
+                cfg_work.append((b, block_by_label[lbl]))
+        else:
+            for s in g.edges[b]:
+                cfg_work.append((b, s))
+
+    def visit(b, inst):
+        if 'op' not in inst:
+            return
+        if inst['op'] == 'phi':
+            visit_phi(b, inst)
+        elif 'dest' in inst:
+            set_value(inst['dest'], evaluate(inst, value))
+        elif inst['op'] == 'br':
+            visit_term(b)
+
+    while cfg_work or ssa_work:
+        while cfg_work:
+            (p, s) = cfg_work.pop()
+            if (p, s) in exec_edges:
+                continue
+            exec_edges.add((p, s))
+
+            if executable[s]:
+                # a new way in: only the phis can change
+                for inst in g.blocks[s]:
+                    if 'op' in inst and inst['op'] == 'phi':
+                        visit_phi(s, inst)
+            else:
+                executable[s] = True
+                for inst in g.blocks[s]:
+                    visit(s, inst)
+                visit_term(s)
+
+        while ssa_work:
+            (b, inst) = ssa_work.pop()
+            if executable[b]:
+                visit(b, inst)
+
+    # Phis don't have types, so take them from their args
+    types = {}
+    for arg in func.get('args', []):
+        types[arg['name']] = arg['type']
+    phis = []
+    for inst in func['instrs']:
+        if 'dest' in inst:
+            if inst['op'] == 'phi':
+                phis.append(inst)
+            else:
+                types[inst['dest']] = inst['type']
+    changed = True
+    while changed:
+        changed = False
+        for inst in phis:
+            if inst['dest'] not in types:
+                for a in inst['args']:
+                    if a in types:
+                        types[inst['dest']] = types[a]
+                        changed = True
+                        break
+
+    # Rewrite the program
+    cfg_changed = False
+    newinstrs = []
+    for b,block in enumerate(g.blocks):
+        if not executable[b]:
+            cfg_changed = True
+            continue
+
+        newblock = []
+        consts = [] # replacements for phis, which go after the phis
+        for inst in block:
+            if 'op' not in inst:
+                newblock.append(inst)
+                continue
+
+            op = inst['op']
+
+            if 'dest' in inst and op != 'const' and inst['dest'] in types:
+                v = value.get(inst['dest'])
+                if v is not None and v != NAC:
+                    c = {'op': 'const', 'dest': inst['dest'],
+                         'type': types[inst['dest']], 'value': v}
+                    if op == 'phi':
+                        consts.append(c)
+                    else:
+                        newblock.append(c)
+                    continue
+
+            if op == 'phi':
+                args = []
+                labels = []
+                for (a, lbl) in zip(inst['args'], inst['labels']):
+                    if (block_by_label.get(lbl), b) in exec_edges:
+                        args.append(a)
+                        labels.append(lbl)
+                inst['args'] = args
+                inst['labels'] = labels
+
+            elif op == 'br':
+                cond = value.get(inst['args'][0])
+                if cond is not None and cond != NAC:
+                    inst = {'op': 'jmp', 'labels': [inst['labels'][0 if cond else 1]]}
+                    cfg_changed = True
+
+            newblock.append(inst)
+
+        if consts:
+            i = 0
+            while i < len(newblock) and ('label' in newblock[i] or newblock[i]['op'] == 'phi'):
+                i += 1
+            newblock[i:i] = consts
+
+        newinstrs += newblock
+
+    func['instrs'] = newinstrs
+
+    fa.invalidate('cfg' if cfg_changed else 'reaching_defs')
+
+# am: an analysis.AnalysisManager to share analyses with other passes, if any
+def sccp(prog, am=None):
+    for func in prog['functions']:
+        if func['instrs']:
+            sccp_func(func, am.function(func) if am else FunctionAnalyses(func))
+    return prog
+
+def main():
+    brilbin.flag(sys.argv)
+    map_functions(sccp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# A compile server: keeps every pass loaded in one long-lived process, so a
+# pipeline stage (run through client.py) doesn't pay for starting python and
+# importing the optimizer, which for benchmark-sized programs is most of the
+# time a stage takes.
+#
+# usage: server.py [SOCKET]
+#
+# Listens on the Unix socket SOCKET (default: $BRIL_SERVER, or
+# $TMPDIR/bril-server-<uid>.sock; see client.socket_path) until killed. Each
+# request is the arguments and input for one pipeline.py run (see
+# client.request), done in the client's working directory and with its
+# BRIL_STATS/BRIL_CACHE settings.
+#
+# Every request is handled in a child forked from the server: it starts with
+# all the modules already imported, but whatever one request does (chdir,
+# analysis and stats state, a crash) can't affect any other, and requests
+# from parallel stages run at the same time.
+
+import io
+import os
+import signal
+import socket
+import socketserver
+import sys
+import traceback
+import pipeline
+import stats
+from cache import tool_version
+from client import ENV, socket_path
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+# Run pipeline.py on a request (in the child handling it). fields: as sent by
+# client.request. Returns (exit status, stdout, stderr), the last two as bytes.
+def run(fields, data):
+    cwd = fields[0]
+    env = fields[1:1 + len(ENV)]
+    args = fields[1 + len(ENV):]
+
+    # (binary streams underneath, as for the real ones: programs may be binary)
+    out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    err = io.StringIO()
+    sys.stdin = io.TextIOWrapper(io.BufferedReader(io.BytesIO(data)), encoding='utf-8')
+    sys.stdout = out
+    sys.stderr = err
+    sys.argv = [os.path.join(ROOT, 'pipeline.py')] + args
+
+    status = 0
+    try:
+        os.chdir(cwd)
+        for (name, value) in zip(ENV, env):
+            if value:
+                os.environ[name] = value
+            else:
+                os.environ.pop(name, None)
+        stats.ENABLED = False
+        if os.environ.get('BRIL_STATS'):
+            stats.enable()
+        pipeline.main()
+    except SystemExit as e:
+        if isinstance(e.code, str):
+            print(e.code, file=err)
+            status = 1
+        else:
+            status = e.code or 0
+    except Exception:
+        traceback.print_exc()
+        status = 1
+
+    # (the child exits without running atexit handlers)
+    if stats.ENABLED:
+        stats.report()
+    out.flush()
+    return (status, out.buffer.getvalue(), err.getvalue().encode())
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        fields = self.rfile.readline().decode().rstrip('\n').split('\0')
+        data = self.rfile.read()
+        (status, out, err) = run(fields, data)
+        self.wfile.write('{} {}\n'.format(status, len(err)).encode())
+        self.wfile.write(err)
+        self.wfile.write(out)
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+# Is a server already listening at path?
+def listening(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else socket_path()
+    if os.path.exists(path):
+        if listening(path):
+            print("error: a server is already listening on {}".format(path),
+                  file=sys.stderr)
+            sys.exit(1)
+        os.remove(path) # left behind by one that was killed
+
+    # Import everything up front, so no request has to; with that done, the
+    # cache's tool version can be computed once for all of them too.
+    for name in pipeline.PASSES:
+        pipeline.load_pass(name)
+    tool_version()
+
+    server = Server(path, Handler)
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    print("listening on {}".format(path), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
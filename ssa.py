@@ -2,64 +2,106 @@
 
 import sys
 import json
-from dom import Dominators
 from brilpy import *
+from analysis import FunctionAnalyses
+from dataflow import LiveVars, var_args
 from functools import reduce
 
 TERM = 'jmp', 'br', 'ret'
 
-def to_ssa(prog):
+# Where to_ssa places phis. For a variable v and a block b in the (iterated)
+# dominance frontier of v's definitions, a phi for v goes in b:
+#   MINIMAL: always
+#   SEMI_PRUNED: if v is a "non-local name", i.e., it's read in some block
+#                before being assigned there (names that only live within one
+#                block never need phis)
+#   PRUNED: if v is live on entry to b
+MINIMAL = 'minimal'
+SEMI_PRUNED = 'semi-pruned'
+PRUNED = 'pruned'
+
+# am: an analysis.AnalysisManager to take the CFG and dominators from (and to
+#     invalidate as the program changes), if any
+def analyses_for(func, am):
+    return am.function(func) if am else FunctionAnalyses(func)
+
+# mode: MINIMAL, SEMI_PRUNED or PRUNED
+def to_ssa(prog, am=None, mode=PRUNED):
     for func in prog['functions']:
 
+        fa = analyses_for(func, am)
+        changed = False # whether the fixups below changed func['instrs']
+
         # Add dummy id operations for each argument.
         # This is a bit of a hack because of the fact that you can reassign to
         # the args anywhere in the function.
         # We don't want the first block to be a place we can jump to, because
         # we can't have a phi as the first instruction to disambiguate args
-        if 'args' in func:
-            if func['args']:
-                for a in func['args']:
-                    func['instrs'] = [{'op':'id', 'args':[a['name']], 'type':a['type'], 'dest':a['name']}] + \
-                                     func['instrs']
-                func['instrs'] = [{'label':'pre_entry'}] + func['instrs']
+        if mode == MINIMAL:
+            if 'args' in func:
+                if func['args']:
+                    for a in func['args']:
+                        func['instrs'] = [{'op':'id', 'args':[a['name']], 'type':a['type'], 'dest':a['name']}] + \
+                                         func['instrs']
+                    func['instrs'] = [{'label':'pre_entry'}] + func['instrs']
+                    changed = True
+
+        # Otherwise only the args that are reassigned need copies, and the
+        # pre_entry block is only needed for those, or if the first block is a
+        # jump target
+        else:
+            dests = set([inst['dest'] for inst in func['instrs'] if 'dest' in inst])
+            copies = [{'op':'id', 'args':[a['name']], 'type':a['type'], 'dest':a['name']}
+                      for a in func.get('args', []) if a['name'] in dests]
+
+            targets = set()
+            for inst in func['instrs']:
+                targets.update(inst.get('labels', []))
+            first = func['instrs'][0] if func['instrs'] else {}
+
+            if first.get('label') in targets:
+                copies.append({'op':'jmp', 'labels':[first['label']]})
+            if copies:
+                func['instrs'] = [{'label':'pre_entry'}] + copies + func['instrs']
+                changed = True
 
         # Next we need to canonicalize labels, in case any labels appear
-        # directly in a row, this would break things later
-        label_last = False
-        last = None
-        i = 0
-        while i < len(func['instrs']):
-            inst = func['instrs'][i]
+        # directly in a row, this would break things later. Each label in a run
+        # is an alias for the first one.
+        alias = {}
+        newinstrs = []
+        last = None # the label just before this instruction, if any
+        for inst in func['instrs']:
             if 'label' in inst:
-                if label_last:
-                    for j in func['instrs']:
-                        if 'labels' in j and inst['label'] in j['labels']:
-                            labels = []
-                            for lbl in j['labels']:
-                                if lbl == inst['label']:
-                                    labels.append(last['label'])
-                                else:
-                                    labels.append(lbl)
-                            j['labels'] = labels
-                    func['instrs'].pop(i)
-
-                else:
-                    i += 1
-                    last = inst
-                    label_last = True
+                if last is not None:
+                    alias[inst['label']] = last['label']
+                    continue
+                last = inst
             else:
-                i += 1
-                label_last = False
+                last = None
+            newinstrs.append(inst)
+        label_last = last is not None
+
+        if alias:
+            func['instrs'] = newinstrs
+            for inst in newinstrs:
+                if 'labels' in inst and any(l in alias for l in inst['labels']):
+                    inst['labels'] = [alias.get(l, l) for l in inst['labels']]
+            changed = True
 
         # This last bit is just because even after the above, a valid bril
         # program could end with a label, but we don't want that (i.e., an empty
         # block
         if label_last:
             func['instrs'].append({'op':'ret'});
+            changed = True
+
+        if changed:
+            fa.invalidate('cfg')
 
-        g = CFG(func)
+        g = fa.cfg()
 
-        domins = Dominators(func)
+        domins = fa.dominators()
 
         defs = {}
         for i,b in enumerate(g.blocks):
@@ -80,16 +122,37 @@ def to_ssa(prog):
         for i in range(g.n):
             phis.append({})
 
+        # whether v needs a phi in block b (given b is in the frontier)
+        if mode == MINIMAL:
+            def wants_phi(v, b):
+                return True
+        else:
+            live = LiveVars(func, g)
+            if mode == PRUNED:
+                (live_in, live_out) = live.run(g)
+            else:
+                nonlocal_names = reduce(lambda x,y: x | y, live.gen, 0)
+
+            def wants_phi(v, b):
+                i = live.vars.ids.get(v)
+                if i is None:
+                    return False # never read
+                if mode == PRUNED:
+                    return (live_in[b] >> i) & 1
+                return (nonlocal_names >> i) & 1
+
         # Following pseudocode from Lesson 5 notes
         # ``Step one''
         for v,vdefs in defs.items():
-            for d in vdefs:
+            def_set = set(vdefs)
+            for d in vdefs: # (vdefs grows as we go)
                 for b in domins.frontier[d]:
-                    if v not in phis[b]:
+                    if v not in phis[b] and wants_phi(v, b):
                         phis[b][v] = {'op':'phi', 'args':[], 'labels':[]} # will handle dest/args later
 
-                    if b not in defs[v]:
-                        defs[v].append(b)
+                        if b not in def_set:
+                            def_set.add(b)
+                            vdefs.append(b)
 
         # ``Step two''
         stack = {}
@@ -110,45 +173,47 @@ def to_ssa(prog):
             stack[ogvar].append(n)
             return n
 
-        # b: index of block
-        def rename(b):
-
+        # Walk the dominator tree with an explicit stack of (block, the vars
+        # whose names the block pushed, or None if the block hasn't been visited
+        # yet), so deep trees don't hit the recursion limit
+        work = [(0, None)]
+        while work:
+            (b, pushed) = work.pop()
+
+            # done with b's subtree: pop all the names it pushed
+            if pushed is not None:
+                for v in pushed:
+                    stack[v].pop()
+                continue
 
-            # map from vars to count of names pushed (so we can pop them)
-            push_count = {}
+            pushed = []
 
             for v,p in phis[b].items():
                 p['dest'] = new_name(v)
+                pushed.append(v)
 
             for instr in g.blocks[b]:
 
-                # replace old names with stack names
+                # replace old names with stack names (in place; the assignment
+                # back is for compactir.Instrs, whose args aren't a list)
                 if 'args' in instr:
-                    newargs = []
-                    if 'op' in instr and instr['op'] == 'getmbr':
-                        newargs.append(stack[instr['args'][0]][-1])
-                        newargs.append(instr['args'][1])
-                    else:
-                        for arg in instr['args']:
-                            newargs.append(stack[arg][-1])
-                    instr['args'] = newargs
+                    args = instr['args']
+                    n = 1 if instr.get('op') == 'getmbr' else len(args)
+                    for k in range(n):
+                        args[k] = stack[args[k]][-1]
+                    instr['args'] = args
 
                 # replace destination with new name (and push onto stack)
                 if 'dest' in instr:
-                    name = new_name(instr['dest'])
-                    if instr['dest'] in push_count:
-                        push_count[instr['dest']] += 1
-                    else:
-                        push_count[instr['dest']] = 1
-
-                    instr['dest'] = name
+                    pushed.append(instr['dest'])
+                    instr['dest'] = new_name(instr['dest'])
 
             for s in g.edges[b]:
 
-                for v in set(phis[s].keys()): # (copy keyset so we can remove)
+                for v in list(phis[s]): # (copy keys so we can remove)
 
                     # we found a path to this block where it is unassigned: this phi should go away
-                    if not stack[v]: 
+                    if not stack[v]:
                         phis[s].pop(v)
 
                     # otherwise update the var-use to use the current name
@@ -156,16 +221,10 @@ def to_ssa(prog):
                         phis[s][v]['args'].append(stack[v][-1])
                         phis[s][v]['labels'].append(g.names[b])
 
-            if b in domins.dom_tree:
-                for b_dom in domins.dom_tree[b]:
-                    rename(b_dom)
-
-            # pop all the names
-            for var,count in push_count.items():
-                for j in range(count):
-                    stack[var].pop()
-
-        rename(0)
+            # come back to b after its subtree
+            work.append((b, pushed))
+            for c in reversed(domins.dom_tree.get(b, [])):
+                work.append((c, None))
 
 
         # Add labels to blocks missing labels, and add jumps to blocks that fall
@@ -185,23 +244,38 @@ def to_ssa(prog):
                 g.blocks[i-1].append({'op':'jmp', 'labels':[b[0]['label']]})
 
 
+        if 'op' not in g.blocks[-1][-1] or g.blocks[-1][-1]['op'] not in TERM:
+            g.blocks[-1].append({'op':'ret'});
+
         # Write all the blocks' instructions to a new "linear" function
         newinstrs = []
         for i,b in enumerate(g.blocks):
             newinstrs += b
 
-        if 'op' not in newinstrs[-1] or newinstrs[-1]['op'] not in TERM:
-            newinstrs.append({'op':'ret'});
-
         func['instrs'] = newinstrs
 
+        # Only labels, jmps and phis were added to the existing blocks, so the
+        # CFG (and so dominators and loops) is unchanged; the names are not.
+        fa.invalidate('reaching_defs')
+
     return prog
 
-def from_ssa(prog):
+def to_ssa_semipruned(prog, am=None):
+    return to_ssa(prog, am, SEMI_PRUNED)
+
+def to_ssa_minimal(prog, am=None):
+    return to_ssa(prog, am, MINIMAL)
+
+# The original translation out of SSA: each phi becomes an id at the end of
+# each predecessor. This is only right if no phi's dest is live out of its
+# predecessors (the "lost copy" problem) and no phi reads another phi's dest
+# (the "swap" problem), which passes like gvn and licm don't guarantee.
+def from_ssa_naive(prog, am=None):
 
     for func in prog['functions']:
 
-        g = CFG(func)
+        fa = analyses_for(func, am)
+        g = fa.cfg()
 
         # First compute a map from label -> block idx
         # Note: we assume every block in SSA form has a label (is this true?)
@@ -235,12 +309,275 @@ def from_ssa(prog):
         # write changes, omitting phis
         newinstr = []
         for i,b in enumerate(g.blocks):
-            for inst in b:
-                if not ('op' in inst and inst['op'] == 'phi'):
-                    newinstr.append(inst)
+            b[:] = [inst for inst in b if not ('op' in inst and inst['op'] == 'phi')]
             if term[i]:
-                newinstr.append(term[i])
+                b.append(term[i])
+            newinstr += b
 
         func['instrs'] = newinstr
 
+        # As with to_ssa, the blocks and edges are unchanged
+        fa.invalidate('reaching_defs')
+
+    return prog
+
+# ------------------------------------------------------------------------------
+# Translation out of SSA with coalescing.
+#
+# Names related by phis (and by ids) are grouped into classes that can share a
+# single variable: two names are only put in the same class if they don't
+# interfere, i.e., neither is live where the other is defined. Every name is
+# then replaced by its class's variable, which turns most phi args into
+# nothing, and the phis are deleted. What remains of the phis on each edge is a
+# parallel copy, done sequentially (with a temporary to break any cycle) at the
+# end of the predecessor, at the start of the successor, or in a new block
+# splitting the edge if it's critical.
+# ------------------------------------------------------------------------------
+
+# Order a parallel copy (a list of (dest, src) with distinct dests) into a list
+# of copies that can be done one after another. `temp(var)` returns a new
+# variable to save var in, for breaking cycles.
+def sequentialize(copies, temp):
+    result = []
+    pending = dict(copies) # dest -> src
+
+    # the number of pending copies reading each var
+    readers = {}
+    for src in pending.values():
+        readers[src] = readers.get(src, 0) + 1
+
+    ready = [d for d in pending if not readers.get(d)]
+    while pending:
+        while ready:
+            d = ready.pop()
+            src = pending.pop(d)
+            result.append((d, src))
+            readers[src] -= 1
+            if readers[src] == 0 and src in pending:
+                ready.append(src)
+
+        if pending:
+            # only cycles are left: save one of their dests so it can be
+            # overwritten
+            d = next(iter(pending))
+            t = temp(d)
+            result.append((t, d))
+            for x in pending:
+                if pending[x] == d:
+                    pending[x] = t
+            readers[t] = readers.pop(d)
+            ready.append(d)
+
+    return result
+
+def from_ssa_func(func, fa):
+    g = fa.cfg()
+
+    block_by_label = {}
+    for i,name in enumerate(g.names):
+        block_by_label[name] = i
+
+    types = {}
+    for arg in func.get('args', []):
+        types[arg['name']] = arg['type']
+    phis = []
+    for inst in func['instrs']:
+        if 'dest' in inst:
+            if inst['op'] == 'phi':
+                phis.append(inst)
+            if 'type' in inst:
+                types[inst['dest']] = inst['type']
+
+    # to_ssa's phis don't have types, so take them from their args
+    changed = True
+    while changed:
+        changed = False
+        for inst in phis:
+            if inst['dest'] not in types:
+                for a in inst['args']:
+                    if a in types:
+                        types[inst['dest']] = types[a]
+                        changed = True
+                        break
+
+    live = LiveVars(func, g)
+    (live_in, live_out) = live.run(g)
+    V = live.vars
+
+    # var id -> bit vector of the vars live where it's defined (for an id, not
+    # counting its source, which holds the same value)
+    interf = {}
+    def interferes_with(d, bits):
+        interf[d] = interf.get(d, 0) | (bits & ~(1 << d))
+
+    for b,block in enumerate(g.blocks):
+        alive = live_out[b]
+        phi_dests = []
+        for inst in reversed(block):
+            if inst.get('op') == 'phi':
+                phi_dests.append(V.id(inst['dest']))
+                continue
+            if 'dest' in inst:
+                d = V.id(inst['dest'])
+                if inst['op'] == 'id':
+                    interferes_with(d, alive & ~(1 << V.id(inst['args'][0])))
+                else:
+                    interferes_with(d, alive)
+                alive &= ~(1 << d)
+            for a in var_args(inst):
+                alive |= 1 << V.id(a)
+
+        # phis are all defined together at the top of the block
+        for d in phi_dests:
+            interferes_with(d, alive)
+
+    arg_bits = 0
+    for arg in func.get('args', []):
+        a = V.id(arg['name'])
+        arg_bits |= 1 << a
+        interferes_with(a, live_in[0])
+
+    # Union-find over var ids, with the set of members and the vars that
+    # interfere with them for each class
+    parent = {}
+    members = {}
+    conflicts = {}
+
+    def find(x):
+        if x not in parent:
+            parent[x] = x
+            members[x] = 1 << x
+            conflicts[x] = interf.get(x, 0)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def coalesce(a, b):
+        if types.get(V.items[a]) != types.get(V.items[b]):
+            return
+        ra = find(a)
+        rb = find(b)
+        if ra == rb:
+            return
+        if conflicts[ra] & members[rb] or conflicts[rb] & members[ra]:
+            return
+        if members[ra] & arg_bits and members[rb] & arg_bits:
+            return # (args can't be renamed)
+        parent[rb] = ra
+        members[ra] |= members[rb]
+        conflicts[ra] |= conflicts[rb]
+
+    # Coalesce the copies in the most deeply nested loops first
+    forest = fa.loops()
+    candidates = []
+    for b,block in enumerate(g.blocks):
+        for inst in block:
+            if inst.get('op') == 'phi':
+                for (a, lbl) in zip(inst['args'], inst['labels']):
+                    p = block_by_label.get(lbl)
+                    depth = forest.depth(p) if p is not None else 0
+                    candidates.append((depth, inst['dest'], a))
+            elif inst.get('op') == 'id':
+                candidates.append((forest.depth(b), inst['dest'], inst['args'][0]))
+    candidates.sort(key=(lambda c: -c[0]))
+    for (depth, d, a) in candidates:
+        coalesce(V.id(d), V.id(a))
+
+    # Each class is named after its arg, if it has one
+    name = {}
+    for arg in func.get('args', []):
+        name[find(V.id(arg['name']))] = arg['name']
+
+    def rename(var):
+        r = find(V.id(var))
+        if r not in name:
+            name[r] = V.items[r]
+        return name[r]
+
+    used = set(V.items)
+    def temp(var):
+        t = var + '.tmp'
+        i = 0
+        while t in used:
+            i += 1
+            t = '{}.tmp.{}'.format(var, i)
+        used.add(t)
+        types[t] = types.get(var)
+        return t
+
+    def copy(d, src):
+        inst = {'op': 'id', 'dest': d, 'args': [src]}
+        if types.get(d) is not None:
+            inst['type'] = types[d]
+        return inst
+
+    # (pred, succ) -> parallel copy for the edge
+    edge_copies = {}
+    for s,block in enumerate(g.blocks):
+        for inst in block:
+            if inst.get('op') == 'phi':
+                d = rename(inst['dest'])
+                for (a, lbl) in zip(inst['args'], inst['labels']):
+                    a = rename(a)
+                    if a != d and lbl in block_by_label:
+                        edge_copies.setdefault((block_by_label[lbl], s), []).append((d, a))
+
+    # Rename everything, dropping phis and the ids that now copy a var to itself
+    for block in g.blocks:
+        newblock = []
+        for inst in block:
+            if inst.get('op') == 'phi':
+                continue
+            if 'args' in inst:
+                args = inst['args']
+                n = 1 if inst.get('op') == 'getmbr' else len(args)
+                for k in range(n):
+                    args[k] = rename(args[k])
+                inst['args'] = args
+            if 'dest' in inst:
+                inst['dest'] = rename(inst['dest'])
+                if inst['op'] == 'id' and inst['args'][0] == inst['dest']:
+                    continue
+            newblock.append(inst)
+        block[:] = newblock
+
+    # Place the copies
+    labels = set(g.names)
+    after = {} # block idx -> blocks splitting its edges
+    for ((p, s), copies) in edge_copies.items():
+        seq = [copy(d, src) for (d, src) in sequentialize(copies, temp)]
+        last = g.blocks[p][-1]
+
+        if len(set(g.edges[p])) == 1 and last.get('op') != 'br':
+            if last.get('op') in TERM:
+                g.blocks[p][-1:-1] = seq
+            else:
+                g.blocks[p] += seq
+
+        elif len(set(g.preds[s])) == 1:
+            g.blocks[s][1:1] = seq # (after the label)
+
+        else:
+            split = g.names[p] + '.' + g.names[s]
+            while split in labels:
+                split += '_'
+            labels.add(split)
+            last['labels'] = [split if l == g.names[s] else l for l in last['labels']]
+            after.setdefault(p, []).append([{'label': split}] + seq +
+                                           [{'op': 'jmp', 'labels': [g.names[s]]}])
+
+    newinstrs = []
+    for b,block in enumerate(g.blocks):
+        newinstrs += block
+        for split in after.get(b, []):
+            newinstrs += split
+    func['instrs'] = newinstrs
+
+    fa.invalidate('cfg' if after else 'reaching_defs')
+
+def from_ssa(prog, am=None):
+    for func in prog['functions']:
+        if func['instrs']:
+            from_ssa_func(func, analyses_for(func, am))
     return prog
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+# Mark Moeller:
+# Instrumentation shared by the passes, analyses and tools, for finding out
+# where the time goes.
+#
+# Off unless BRIL_STATS is set in the environment (or a tool is given --stats,
+# see flag()). When on, the process writes one line of JSON to stderr as it
+# exits:
+#
+#   {"tool": "pipeline.py",
+#    "passes": [{"name": "licm", "seconds": ..., "instrs_in": ..., "instrs_out": ...,
+#                "phis_in": ..., "phis_out": ...}, ...],
+#    "counters": {"analysis.dominators.seconds": ..., "dominators.rounds": ...,
+#                 "dataflow.LiveVars.iterations": ..., ...},
+#    "peak_rss_kb": ...}
+#
+# Counters are summed over the whole run: `<name>.seconds` and `<name>.calls`
+# for each timer(), plus whatever else code records with add(). When off, each
+# of these costs a check of ENABLED.
+
+import atexit
+import json
+import os
+import sys
+import time
+
+ENABLED = False
+
+counters = {}
+passes = []
+
+def enable():
+    global ENABLED
+    if not ENABLED:
+        ENABLED = True
+        atexit.register(report)
+
+# Turn stats on if argv has --stats. Returns argv without it.
+def flag(argv):
+    if '--stats' in argv:
+        enable()
+        argv = [a for a in argv if a != '--stats']
+    return argv
+
+def add(name, n=1):
+    if ENABLED:
+        counters[name] = counters.get(name, 0) + n
+
+class timer:
+    """ Context manager adding the time spent in it to counter
+    `<name>.seconds`, and 1 to `<name>.calls`.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if ENABLED:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if ENABLED:
+            add(self.name + '.seconds', time.perf_counter() - self.start)
+            add(self.name + '.calls')
+        return False
+
+# (instructions, phis) in prog, not counting labels
+def ir_size(prog):
+    instrs = 0
+    phis = 0
+    for func in prog['functions']:
+        for inst in func['instrs']:
+            if 'op' in inst:
+                instrs += 1
+                if inst['op'] == 'phi':
+                    phis += 1
+    return (instrs, phis)
+
+# Run pass fn (program -> program) on prog, recording its time and the size of
+# the program before and after under `name`
+def run_pass(name, fn, prog):
+    if not ENABLED:
+        return fn(prog)
+
+    (instrs, phis) = ir_size(prog)
+    start = time.perf_counter()
+    prog = fn(prog)
+    seconds = time.perf_counter() - start
+    (instrs_out, phis_out) = ir_size(prog)
+    passes.append({'name': name, 'seconds': seconds, 'instrs_in': instrs,
+                   'instrs_out': instrs_out, 'phis_in': phis, 'phis_out': phis_out})
+    return prog
+
+# Fold the pass entries recorded since passes[start] into one per pass, for a
+# sequence of n passes that was run over and over (e.g., once per function)
+def fold(start, n=1):
+    runs = passes[start:]
+    del passes[start:]
+    for i in range(min(n, len(runs))):
+        entry = dict(runs[i])
+        for other in runs[i + n::n]:
+            for k in entry:
+                if k != 'name':
+                    entry[k] += other[k]
+        passes.append(entry)
+
+# Remove and return the counters recorded so far (e.g., to send them from a
+# worker process to be merge()d by its parent)
+def take():
+    taken = dict(counters)
+    counters.clear()
+    return taken
+
+def merge(taken):
+    for (name, n) in taken.items():
+        add(name, n)
+
+def report():
+    import resource
+    out = {'tool': os.path.basename(sys.argv[0]), 'passes': passes,
+           'counters': dict(sorted(counters.items())),
+           'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    sys.stderr.write(json.dumps(out) + '\n')
+    sys.stderr.flush()
+
+if os.environ.get('BRIL_STATS'):
+    enable()